@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+"""
+Times Poirot on synthetic repositories, in committed and staged mode
+and across pattern set sizes. Run from the repository's root with:
+
+    python -m benchmarks.run --commits=500 --save=results.json
+
+and compare with an earlier run by adding --compare=earlier.json.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+from argparse import ArgumentParser
+
+from .synthetic import make_repo, stage_changes
+
+DEFAULT_PATTERNS = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+                                "poirot", "patterns", "default.txt")
+
+
+def parse_arguments(args):
+    query = ArgumentParser(prog="benchmarks.run", description="Benchmark Poirot on synthetic repositories")
+    query.add_argument("--commits", type=int, default=200, help="Commits in the repository")
+    query.add_argument("--files", type=int, default=20, help="Files in the repository")
+    query.add_argument("--diff-lines", type=int, default=50, help="Lines added per commit")
+    query.add_argument("--staged-lines", type=int, default=5000, help="Lines staged in staged mode")
+    query.add_argument("--secret-density", type=float, default=0.01,
+                       help="Fraction of added lines containing a secret")
+    query.add_argument("--pattern-sizes", default="1,18,100",
+                       help="Comma-separated numbers of patterns to search for")
+    query.add_argument("--jobs", type=int, default=1, help="Passed on to poirot --jobs")
+    query.add_argument("--save", help="Write the results as JSON to this file")
+    query.add_argument("--compare", help="Compare with results saved by an earlier run")
+    query.add_argument("--case", help="Run a single case described as JSON (used internally)")
+    return query.parse_args(args)
+
+
+def write_patterns(path, size):
+    """
+    Writes a pattern file of the given size: the default patterns,
+    cut short or padded with synthetic ones.
+    """
+
+    with open(DEFAULT_PATTERNS) as infile:
+        patterns = [line.strip() for line in infile if line.strip() and not line.startswith("#")]
+    patterns = patterns[:size]
+    patterns.extend("SYNTH{}_[A-Z]{{4}}[0-9]+".format(i) for i in range(size - len(patterns)))
+    with open(path, "w") as outfile:
+        outfile.write("\n".join(patterns) + "\n")
+
+
+def run_case(case):
+    """
+    Runs Poirot once, in this process, as described by case. Prints
+    the elapsed time and peak memory use as JSON.
+    """
+
+    import resource
+    from poirot.poirot import main
+
+    os.chdir(case["repo"])
+    args = ["--dir={}".format(case["repo"]), "--patterns={}".format(case["patterns"]),
+            "--jobs={}".format(case["jobs"])]
+    args.append("--staged" if case["mode"] == "staged" else "--revlist=all")
+
+    start = time.time()
+    main(args=args, render_results=False, skip_clone_pull=True)
+    elapsed = time.time() - start
+
+    scale = 1024 if sys.platform == "darwin" else 1  # ru_maxrss is in bytes on macOS
+    print(json.dumps({
+        "seconds": elapsed,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // scale,
+        "peak_child_rss_kb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // scale
+    }))
+
+
+def time_case(case):
+    """
+    Runs a case in a fresh interpreter, so that its peak memory use
+    is its own. Returns the measurements it prints.
+    """
+
+    root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    env = dict(os.environ, PYTHONPATH=root + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    with open(os.devnull, "w") as devnull:
+        out = subprocess.check_output([sys.executable, "-m", "benchmarks.run", "--case", json.dumps(case)],
+                                      cwd=root, env=env, stderr=devnull)
+    return json.loads(out.decode("utf-8").strip().splitlines()[-1])
+
+
+def main(args=sys.argv[1:]):
+    options = parse_arguments(args)
+    if options.case:
+        return run_case(json.loads(options.case))
+
+    workdir = tempfile.mkdtemp(prefix="poirot-bench-")
+    try:
+        repo = os.path.join(workdir, "repo")
+        print("Building a repository of {} commits...".format(options.commits))
+        params = make_repo(repo, commits=options.commits, files=options.files,
+                           diff_lines=options.diff_lines, secret_density=options.secret_density)
+
+        runs = []
+        for size in [int(size) for size in options.pattern_sizes.split(",")]:
+            patterns = os.path.join(workdir, "patterns_{}.txt".format(size))
+            write_patterns(patterns, size)
+            for mode in ["committed", "staged"]:
+                if mode == "staged":
+                    lines = stage_changes(repo, options.staged_lines, options.secret_density)
+                else:
+                    subprocess.check_call(["git", "-C", repo, "reset", "-q", "--hard"])
+                    lines = params["lines_added"]
+                case = {"repo": repo, "patterns": patterns, "mode": mode, "jobs": options.jobs}
+                measured = time_case(case)
+                run = {"mode": mode, "patterns": size, "lines": lines}
+                run.update(measured)
+                if mode == "committed":
+                    run["commits_per_second"] = params["commits"] / measured["seconds"]
+                run["lines_per_second"] = lines / measured["seconds"]
+                runs.append(run)
+                print("{mode:>9} {patterns:>4} patterns: {seconds:8.3f}s {lines_per_second:12.0f} lines/s "
+                      "{peak_rss_kb:8d} KB peak".format(**run))
+    finally:
+        shutil.rmtree(workdir)
+
+    report = {"parameters": dict(params, jobs=options.jobs), "runs": runs}
+    if options.save:
+        with open(options.save, "w") as outfile:
+            json.dump(report, outfile, indent=4)
+    if options.compare:
+        compare(report, options.compare)
+    return report
+
+
+def compare(report, path):
+    """
+    Prints how much faster or slower each run was than the matching
+    run saved at path.
+    """
+
+    with open(path) as infile:
+        earlier = {(run["mode"], run["patterns"]): run for run in json.load(infile)["runs"]}
+    print("Compared with {}:".format(path))
+    for run in report["runs"]:
+        before = earlier.get((run["mode"], run["patterns"]))
+        if before:
+            print("{:>9} {:>4} patterns: {:6.2f}x time, {:6.2f}x peak memory".format(
+                run["mode"], run["patterns"], run["seconds"] / before["seconds"],
+                float(run["peak_rss_kb"]) / before["peak_rss_kb"]))
+
+
+if __name__ == "__main__":
+    main()
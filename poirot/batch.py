@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import multiprocessing
+from argparse import ArgumentParser
+from multiprocessing.pool import ThreadPool
+
+import regex
+
+from .filters import fail, okay, style
+from .matcher import compile_patterns
+from .parser import parse_arguments
+from .poirot import Poirot
+from .utils import clone_pull, is_git_dir
+
+# how a repository given by its URL, rather than its local path, begins
+URL_RE = regex.compile(r"^([a-z][a-z0-9+.-]*://|[^/\s]+@[^/\s]+:)", regex.I)
+# the search options and PatternSet of a batch worker process, set up once when it starts
+worker_info = None
+worker_pattern_set = None
+
+
+def main(args=sys.argv[1:], render_results=True):
+    batch_args, search_args = parse_batch_arguments(args)
+    repos = list(batch_args.repos)
+    if batch_args.repo_file:
+        with open(batch_args.repo_file) as infile:
+            repos.extend(line.strip() for line in infile
+                         if line.strip() and not line.startswith("#"))
+    if not repos:
+        print(style("No repositories given! List them or give a --repo-file.", "red"))
+        sys.exit(1)
+
+    info = parse_arguments(search_args)
+    os.environ.setdefault("GIT_TERMINAL_PROMPT", "0")  # fail rather than ask for credentials
+    summary = run_batch(repos, info, batch_args)
+
+    with open(os.path.join(batch_args.results, "summary.json"), "w") as outfile:
+        json.dump(summary, outfile, ensure_ascii=False, indent=4)
+
+    if not render_results:
+        return summary
+
+    totals = summary["totals"]
+    out = "Scanned {scanned} of {repos} repositories; {failed} failed, {matched} had matches".format(**totals)
+    print(style(out, "red" if totals["failed"] or totals["matched"] else "darkblue"))
+    sys.exit(1 if totals["failed"] or totals["matched"] else 0)
+
+
+def parse_batch_arguments(args):
+    """
+    Parses the options for the batch itself, returning them along
+    with the remaining arguments, which are the search options
+    (e.g. --patterns, --revlist) used for every repository.
+    """
+
+    query = ArgumentParser(prog="poirot-batch",
+                           description="""Poirot: search many repositories at once.
+                                           Any other poirot option (e.g. --patterns,
+                                           --revlist) applies to every repository.""")
+    query.add_argument("repos", nargs="*",
+                       help="""The URLs or local paths of the repositories to
+                               search.""")
+    query.add_argument("--repo-file", "-rf", dest="repo_file",
+                       help="""A file listing repository URLs or local paths,
+                               each on its own line.""")
+    query.add_argument("--clone-dir", "-cd", dest="clone_dir", default="repos",
+                       help="""The directory to clone repositories given by
+                               URL into, or pull them in if already there.
+                               Defaults to 'repos'.""")
+    query.add_argument("--results", dest="results", default="results",
+                       help="""The directory to write each repository's
+                               results and the summary to. Defaults to
+                               'results'.""")
+    query.add_argument("--jobs", "-j", dest="jobs", type=int, default=multiprocessing.cpu_count(),
+                       help="""The number of repositories to search at once.
+                               Defaults to the number of CPUs.""")
+    query.add_argument("--clone-jobs", "-cj", dest="clone_jobs", type=int, default=4,
+                       help="""The number of repositories to clone or pull at
+                               once. Defaults to 4.""")
+    return query.parse_known_args(args)
+
+
+def name_repos(repos):
+    """
+    Returns a name for each repository, from the last parts of its URL
+    or path, to name its results file and clone directory with.
+    """
+
+    names, seen = [], set()
+    for repo in repos:
+        parts = [part for part in regex.split(r"[/:]", repo.rstrip("/")) if part]
+        name = "_".join(parts[-2:]) if URL_RE.match(repo) else parts[-1] if parts else "repo"
+        name = regex.sub(r"[^\w.-]", "_", regex.sub(r"\.git$", "", name))
+        unique, count = name, 1
+        while unique in seen:
+            count += 1
+            unique = "{}_{}".format(name, count)
+        seen.add(unique)
+        names.append(unique)
+    return names
+
+
+def repo_info(info, repo_dir, output):
+    """
+    Returns a copy of the search options info for the repository at
+    repo_dir, writing its results to output.
+    """
+
+    scoped = dict(info, dir=repo_dir, repo_dir=repo_dir, git_dir=repo_dir + "/.git",
+                  git_url="", output=output, jobs=1)
+    if info["state"] == os.path.join(info["dir"], ".git", "poirot_state.json"):
+        scoped["state"] = os.path.join(repo_dir, ".git", "poirot_state.json")
+    if info["index"] == os.path.join(info["dir"], ".git", "poirot_index.sqlite"):
+        scoped["index"] = os.path.join(repo_dir, ".git", "poirot_index.sqlite")
+    return scoped
+
+
+def prepare_repo(job):
+    """
+    Clones or pulls a repository given by its URL, or checks that a
+    repository given by its path exists. Returns the job with the
+    repository's local directory, or the error that stopped it.
+    """
+
+    job = dict(job)
+    try:
+        if URL_RE.match(job["repo"]):
+            job["dir"] = os.path.abspath(os.path.join(job["clone_dir"], job["name"]))
+            clone_pull(job["repo"], job["dir"], pull=True)
+        else:
+            job["dir"] = os.path.abspath(job["repo"])
+        is_git_dir(os.path.join(job["dir"], ".git"))
+    except Exception as error:
+        job["error"] = "{}: {}".format(type(error).__name__, error)
+    return job
+
+
+def init_batch_worker(info):
+    """
+    Compiles the patterns for a batch worker process
+    """
+
+    global worker_info, worker_pattern_set
+    worker_info = info
+    worker_pattern_set = compile_patterns(info)
+
+
+def scan_repo(job):
+    """
+    Searches a repository in a batch worker process, writing its
+    results to its results file. Returns its entry in the summary.
+    """
+
+    record = {"repo": job["repo"], "name": job["name"], "results": job["output"]}
+    start = time.time()
+    try:
+        info = repo_info(worker_info, job["dir"], job["output"])
+        investigator = Poirot([], render_results=False, info=info, pattern_set=worker_pattern_set)
+        investigator.search_all()
+        investigator.git.close()
+        investigator.write_results()
+        record["status"] = "ok"
+        record["matches"] = {pattern: len(commits) for pattern, commits in investigator.results.items()
+                             if commits}
+        if investigator.writer:
+            record["records"] = investigator.writer.count
+    except Exception as error:
+        record["status"] = "failed"
+        record["error"] = "{}: {}".format(type(error).__name__, error)
+    record["seconds"] = time.time() - start
+    return record
+
+
+def run_batch(repos, info, batch_args):
+    """
+    Clones or pulls the repositories a few at a time, handing each
+    to a pool of worker processes to search as soon as it is ready.
+    A repository that fails is recorded as such in the summary, and
+    the rest are still searched. Returns the summary.
+    """
+
+    for directory in (batch_args.clone_dir, batch_args.results):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    extension = ".ndjson" if info["output_format"] == "ndjson" else ".json"
+    jobs = [{"index": index, "repo": repo, "name": name, "clone_dir": batch_args.clone_dir,
+             "output": os.path.abspath(os.path.join(batch_args.results, name + extension))}
+            for index, (repo, name) in enumerate(zip(repos, name_repos(repos)))]
+
+    def report(record):
+        if record["status"] == "ok":
+            found = sum(record["matches"].values()) or record.get("records", 0)
+            print(okay("{}: {} matching commits".format(record["repo"], found)))
+        else:
+            print(fail("{}: {}".format(record["repo"], record["error"])))
+
+    records, pending = {}, {}
+    fetcher = ThreadPool(max(1, batch_args.clone_jobs))
+    pool = multiprocessing.Pool(max(1, batch_args.jobs), init_batch_worker, (info,))
+    try:
+        for job in fetcher.imap_unordered(prepare_repo, jobs):
+            if "error" in job:
+                record = {"repo": job["repo"], "name": job["name"], "status": "failed",
+                          "error": job["error"]}
+                report(record)
+                records[job["index"]] = record
+            else:
+                pending[job["index"]] = pool.apply_async(scan_repo, (job,), callback=report)
+        for index, result in pending.items():
+            records[index] = result.get()
+    finally:
+        fetcher.close()
+        pool.close()
+        pool.join()
+
+    records = [records[index] for index in sorted(records)]
+    failed = sum(1 for record in records if record["status"] == "failed")
+    matched = sum(1 for record in records if record.get("matches") or record.get("records"))
+    return {"repos": records,
+            "totals": {"repos": len(records), "scanned": len(records) - failed,
+                       "failed": failed, "matched": matched}}
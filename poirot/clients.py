@@ -10,32 +10,53 @@ from .filters import fail, okay, highlight, style, wrap, strip
 from .utils import merge_dicts
 
 
+# the Jinja environment, set up the first time results are rendered
+environment = None
+
+
+def get_template(case):
+    """
+    Returns the console template for the case's verbosity, loading
+    the templates only once per process.
+    """
+
+    global environment
+    if environment is None:
+        environment = Environment(loader=PackageLoader("poirot", "templates"))
+        filters = {
+            "okay": okay,
+            "fail": fail,
+            "style": style,
+            "wrap": wrap,
+            "strip": strip,
+            "highlight": highlight
+        }
+        environment.filters = merge_dicts(environment.filters, filters)
+    return environment.get_template("console.html" if case["verbose"] else "console_thin.html")
+
+
+def render_text(results, case):
+    """
+    Returns the results rendered for the console as a string.
+    """
+
+    return "".join(get_template(case).generate(data=results, info=case)) + "\n"
+
+
 def render(results, case):
-    env = Environment(loader=PackageLoader("poirot", "templates"))
-    filters = {
-        "okay": okay,
-        "fail": fail,
-        "style": style,
-        "wrap": wrap,
-        "strip": strip,
-        "highlight": highlight
-    }
-
-    env.filters = merge_dicts(env.filters, filters)
+    template = get_template(case)
 
     if not case["verbose"]:
-        template = env.get_template("console_thin.html")
-        data_to_render = template.render(data=results, info=case)
-        print(data_to_render)
+        for chunk in template.generate(data=results, info=case):
+            sys.stdout.write(chunk)
+        sys.stdout.write("\n")
     else:
-        template = env.get_template("console.html")
-        data_to_render = template.render(data=results, info=case)
         try:
             cmd = ["less", "-F", "-R", "-S", "-X", "-K"]
             pager = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=sys.stdout)
-            lines = data_to_render.split("\n")
-            for line in lines:
-                pager.stdin.write(line.encode("utf-8") + b"\n")
+            for chunk in template.generate(data=results, info=case):
+                pager.stdin.write(chunk.encode("utf-8"))
+            pager.stdin.write(b"\n")
             pager.stdin.close()
             pager.wait()
         except KeyboardInterrupt:
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import errno
+import stat
+import socket
+import tempfile
+from argparse import ArgumentParser
+
+# only the standard library is imported here, so that the client starts
+# quickly; the rest of Poirot is imported when it is needed
+
+# seconds the client waits on the daemon before searching on its own
+CLIENT_TIMEOUT = 60
+
+
+def get_socket_dir():
+    """
+    Returns the directory of the daemon's socket by default: this
+    user's $XDG_RUNTIME_DIR or, without one, a directory of this
+    user's own in the temporary directory.
+    """
+
+    return os.environ.get("XDG_RUNTIME_DIR") or os.path.join(tempfile.gettempdir(),
+                                                             "poirot-{}".format(os.getuid()))
+
+
+def get_socket_path():
+    """
+    Returns the path of the daemon's socket: $POIROT_SOCKET, or
+    poirot.sock in get_socket_dir.
+    """
+
+    return os.environ.get("POIROT_SOCKET") or os.path.join(get_socket_dir(), "poirot.sock")
+
+
+def make_private_dir(path):
+    """
+    Creates the directory path, accessible only by this user, if it
+    doesn't exist. Raises an IOError if it does exist but isn't a
+    directory owned by, and only accessible by, this user (e.g.
+    because another user created it first).
+    """
+
+    try:
+        os.mkdir(path, 0o700)
+    except OSError as error:
+        if error.errno != errno.EEXIST:
+            raise
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise IOError("{} is not a directory only this user can access".format(path))
+
+
+def is_own_socket(path):
+    """
+    Returns whether path is a socket owned by this user, so that no
+    other user's process can pose as the daemon.
+    """
+
+    try:
+        info = os.stat(path)
+    except OSError:
+        return False
+    return stat.S_ISSOCK(info.st_mode) and info.st_uid == os.getuid()
+
+
+def request(message, socket_path=None, timeout=CLIENT_TIMEOUT):
+    """
+    Sends a message (a JSON-serializable dict) to the daemon and
+    returns its response, or None if no daemon answered, or the
+    socket isn't this user's own.
+    """
+
+    socket_path = socket_path or get_socket_path()
+    if not is_own_socket(socket_path):
+        return None
+    try:
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    except (AttributeError, socket.error):  # no Unix sockets on this platform
+        return None
+    try:
+        client.settimeout(timeout)
+        client.connect(socket_path)
+        client.sendall((json.dumps(message) + "\n").encode("utf-8"))
+        client.shutdown(socket.SHUT_WR)
+        response = b"".join(iter(lambda: client.recv(65536), b""))
+        return json.loads(response.decode("utf-8"))
+    except (socket.error, socket.timeout, ValueError):
+        return None
+    finally:
+        client.close()
+
+
+def client_main(args=sys.argv[1:]):
+    """
+    Runs poirot with args through the daemon, or in this process if
+    no daemon is running or it can't take the request.
+    """
+
+    response = request({"args": list(args), "cwd": os.getcwd()})
+    if response is None or "error" in response:
+        from .poirot import main
+        return main(args)
+
+    sys.stdout.write(response["output"])
+    sys.stdout.flush()
+    sys.exit(response["status"])
+
+
+def daemon_main(args=sys.argv[1:]):
+    query = ArgumentParser(prog="poirot-daemon",
+                           description="""Poirot: search staged changes on request,
+                                          keeping patterns compiled between requests.
+                                          Any other poirot option (e.g. --patterns)
+                                          gives patterns to compile in advance.""")
+    query.add_argument("--socket", dest="socket", default=get_socket_path(),
+                       help="""The path of the Unix socket to listen on.
+                               Defaults to $POIROT_SOCKET or poirot.sock
+                               in $XDG_RUNTIME_DIR or, without it, in a
+                               private per-user directory in the temporary
+                               directory.""")
+    query.add_argument("--stop", dest="stop", action="store_true",
+                       help="""Flag to stop the daemon listening on the
+                               socket.""")
+    daemon_args, warm_args = query.parse_known_args(args)
+
+    if daemon_args.stop:
+        stopped = request({"command": "stop"}, daemon_args.socket)
+        print("Stopped the daemon." if stopped else "No daemon is running.")
+        return
+
+    from .clients import get_template
+
+    daemon = Daemon(daemon_args.socket)
+    info, _ = daemon.load(warm_args + ["--staged"])  # compiles the patterns before any request
+    get_template(info)
+    daemon.serve()
+
+
+class Daemon(object):
+    """
+    Listens on a Unix socket for requests to search staged changes,
+    one at a time. Each request gives the arguments poirot would have
+    been run with and the directory it would have been run in. Keeps
+    a PatternSet compiled for each set of patterns it is asked to
+    search for.
+    """
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self.pattern_sets = {}
+        self.running = False
+
+    def load(self, args):
+        """
+        Parses poirot arguments, returning the search options and the
+        PatternSet for them, compiled only the first time they are
+        given.
+        """
+
+        from .matcher import compile_patterns
+        from .parser import parse_arguments
+
+        info = parse_arguments(args)
+        key = (tuple(sorted(info["patterns"])), info["regex_timeout"], info["entropy"])
+        if key not in self.pattern_sets:
+            self.pattern_sets[key] = compile_patterns(info)
+        return info, self.pattern_sets[key]
+
+    def serve(self):
+        """
+        Answers requests until asked to stop.
+        """
+
+        if request({"command": "ping"}, self.socket_path) is not None:
+            raise IOError("A daemon is already listening on {}".format(self.socket_path))
+        if os.path.dirname(self.socket_path) == get_socket_dir():
+            make_private_dir(get_socket_dir())
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)  # left behind by a daemon that didn't stop cleanly
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o177)  # only this user may connect
+        try:
+            server.bind(self.socket_path)
+        finally:
+            os.umask(umask)
+        server.listen(8)
+        self.running = True
+        try:
+            while self.running:
+                connection, _ = server.accept()
+                try:
+                    self.handle(connection)
+                finally:
+                    connection.close()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            os.remove(self.socket_path)
+
+    def handle(self, connection):
+        """
+        Reads a request from a connection and writes back the response.
+        """
+
+        data = b"".join(iter(lambda: connection.recv(65536), b""))
+        try:
+            response = self.respond(json.loads(data.decode("utf-8")))
+        except ValueError:
+            response = {"error": "Malformed request"}
+        connection.sendall((json.dumps(response) + "\n").encode("utf-8"))
+
+    def respond(self, message):
+        """
+        Returns the response to a request: stops the daemon, answers a
+        ping, or searches staged changes, returning the exit status and
+        console output poirot would have given.
+        """
+
+        if message.get("command") == "stop":
+            self.running = False
+            return {"status": 0}
+        elif message.get("command") == "ping":
+            return {"status": 0}
+
+        from .clients import render_text
+        from .filters import style
+        from .poirot import Poirot
+
+        cwd = os.getcwd()
+        try:
+            os.chdir(message["cwd"])  # git diff --staged and relative paths are resolved from it
+            info, pattern_set = self.load(["--dir", message["cwd"]] + message["args"])
+            if not info["staged"]:
+                return {"error": "The daemon only searches staged changes"}
+            if info["output_format"] == "ndjson" and not info["output"]:
+                return {"error": "The daemon can't write ndjson to the client's standard output"}
+
+            investigator = Poirot([], render_results=False, info=info, pattern_set=pattern_set)
+            investigator.search_all()
+            investigator.git.close()
+            investigator.write_results()
+            results = investigator.results
+        except (Exception, SystemExit) as error:
+            return {"error": "{}: {}".format(type(error).__name__, error)}
+        finally:
+            os.chdir(cwd)
+
+        if investigator.writer and investigator.writer.count:
+            out = "Poirot wrote {} matches to {}".format(investigator.writer.count, info["output"])
+            return {"status": 1, "output": style(out, "red") + "\n"}
+        elif any(results.values()):
+            return {"status": 1, "output": render_text(results, info)}
+        return {"status": 0, "output": style("Poirot didn't find anything!", "darkblue") + "\n"}
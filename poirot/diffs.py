@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+
+import sys
+from collections import Counter
+from fnmatch import fnmatchcase
+from itertools import groupby
+
+import regex
+
+from . import stats
+from .utils import to_text
+
+HUNK_RE = regex.compile(br"@@ \-[0-9,]+ \+([0-9]+)[, ].*")
+# what Limits counts, and how it reports each count: the thing counted and why
+SKIP_LABELS = [
+    ("binary", "binary file", ""),
+    ("excluded", "excluded file", ""),
+    ("oversized", "file", " cut short by --max-diff-size"),
+    ("truncated", "line", " cut short by --max-line-length")
+]
+
+
+class Limits(object):
+    """
+    Cuts content out of diffs before it is matched: files whose names
+    match any of the exclude globs, the added lines of a file past its
+    first max_diff_size bytes, and the text of a line past its first
+    max_line_length characters. Counts what it cuts, along with the
+    binary files skipped.
+    """
+
+    def __init__(self, max_diff_size=None, max_line_length=None, exclude=()):
+        self.max_diff_size = max_diff_size
+        self.max_line_length = max_line_length
+        self.exclude = list(exclude)
+        self.skipped = Counter()
+
+    def excludes(self, filename):
+        """
+        Returns whether a file is excluded, counting it if it is.
+        """
+
+        if any(fnmatchcase(filename, glob) for glob in self.exclude):
+            self.skipped["excluded"] += 1
+            return True
+        return False
+
+    def cut_line(self, line):
+        """
+        Returns an added line (starting with its +) cut down to at most
+        max_line_length characters of text.
+        """
+
+        if self.max_line_length is not None and len(line) > self.max_line_length + 1:
+            self.skipped["truncated"] += 1
+            return line[:self.max_line_length + 1]
+        return line
+
+    def cut_file(self, added_lines):
+        """
+        Takes a single file's added lines, as yielded by
+        iter_added_lines, and yields each one cut to max_line_length
+        characters of text, stopping once the file's lines pass
+        max_diff_size characters. Counts the lines it cuts and the
+        file, if it stops early.
+        """
+
+        size = 0
+        for filename, line_num, line in added_lines:
+            line = self.cut_line(line)
+            size += len(line)
+            if self.max_diff_size is not None and size > self.max_diff_size:
+                self.skipped["oversized"] += 1
+                return
+            yield filename, line_num, line
+
+    def drain(self):
+        """
+        Returns the counts so far and starts counting over, as a --jobs
+        worker process does after each shard.
+        """
+
+        skipped, self.skipped = dict(self.skipped), Counter()
+        return skipped
+
+    def merge(self, skipped):
+        self.skipped.update(skipped)
+
+    def summary(self):
+        """
+        Returns a sentence listing the counts, or None if nothing was
+        skipped.
+        """
+
+        counts = ["{} {}{}{}".format(self.skipped[key], noun, "" if self.skipped[key] == 1 else "s",
+                                     reason)
+                  for key, noun, reason in SKIP_LABELS if self.skipped[key]]
+        if counts:
+            return "Skipped {}".format(", ".join(counts))
+        return None
+
+
+def read_added_lines(lines, limits=None):
+    """
+    Reads a unified diff line by line, keeping track of the file
+    and hunk it is in. Yields the position of each file in the diff,
+    its name, its blob change (the names of its pre- and post-image
+    blobs, or None), and the line number and text of each of its
+    added lines, skipping deleted files and anything cut by limits.
+
+    The lines are read as bytes (text lines are encoded first), and
+    only file names and added lines are decoded.
+    """
+
+    position, filename, blobs, in_hunk, line_num, size = -1, None, None, False, 0, 0
+    for line in lines:
+        if not isinstance(line, bytes):
+            line = line.encode("utf-8")
+        if line.startswith(b"diff --git "):
+            try:
+                filename = to_text(line.rstrip(b"\n").split(b" b/", 1)[1])
+            except IndexError:
+                filename = None
+            if filename is not None and limits and limits.excludes(filename):
+                filename = None
+            position, blobs, in_hunk, size = position + 1, None, False, 0
+        elif filename is None:
+            pass
+        elif not in_hunk and line.startswith(b"deleted file"):
+            filename = None
+        elif not in_hunk and line.startswith(b"index "):
+            blobs = tuple(line.split()[1].split(b"..", 1))
+        elif not in_hunk and line.startswith(b"Binary files "):
+            if limits:
+                limits.skipped["binary"] += 1
+        elif line.startswith(b"@@"):
+            hunk = HUNK_RE.match(line)
+            if hunk:
+                line_num = int(hunk.group(1))
+                in_hunk = True
+        elif in_hunk and line.startswith(b"+"):
+            line = to_text(line.rstrip(b"\n"))
+            if limits:
+                line = limits.cut_line(line)
+                size += len(line)
+                if limits.max_diff_size is not None and size > limits.max_diff_size:
+                    limits.skipped["oversized"] += 1
+                    filename = None  # skip the rest of the file
+                    continue
+            yield position, filename, blobs, line_num, line
+            line_num += 1
+
+
+def iter_added_lines(lines, limits=None):
+    """
+    Reads a unified diff line by line, keeping track of the file
+    and hunk it is in. Yields the file name, line number, and text
+    of each added line, skipping deleted files and anything cut by
+    limits.
+    """
+
+    added_lines = stats.timed_iter("parse_diff", read_added_lines(lines, limits))
+    for position, filename, blobs, line_num, line in added_lines:
+        yield filename, line_num, line
+
+
+def iter_file_diffs(lines, limits=None):
+    """
+    Reads a unified diff line by line. Yields the name and blob change
+    of each file with added lines, along with an iterator over them
+    (as yielded by iter_added_lines), which must be consumed before
+    the next file.
+    """
+
+    added_lines = stats.timed_iter("parse_diff", read_added_lines(lines, limits))
+    for (position, filename, blobs), added in groupby(added_lines, key=lambda added: added[:3]):
+        yield filename, blobs, ((name, line_num, line) for _, name, _, line_num, line in added)
+
+
+def text_span(match, offset, length):
+    """
+    Returns the start and end of a match within the part of the line
+    beginning at offset and length characters long.
+    """
+
+    start = min(max(match.start() - offset, 0), length)
+    end = min(max(match.end() - offset, start), length)
+    return [start, end]
+
+
+def iter_matches(added_lines, pattern_set):
+    """
+    Takes added lines, as yielded by iter_added_lines, and a
+    PatternSet. Yields each pattern, file name, and line that match,
+    along with the span of the match within the line's text. If the
+    PatternSet has an entropy detector, also yields the high-entropy
+    strings it finds in the lines, a batch of lines at a time.
+    """
+
+    if pattern_set.detector is None:
+        batched = ((added, None) for added in added_lines)
+    else:
+        batched = pattern_set.detector.iter_hits(added_lines)
+
+    for (filename, line_num, line), extra_hits in batched:
+        hits = pattern_set.search(line)
+        if extra_hits:
+            hits = hits + extra_hits
+        if hits:
+            text = line[1:].strip()
+            offset = 1 + len(line[1:]) - len(line[1:].lstrip())  # where text starts in line
+            for pattern, match in hits:
+                yield pattern, filename, {"line": line_num, "text": text,
+                                          "span": text_span(match, offset, len(text))}
+
+
+def iter_blob_matches(lines, pattern_set, blob_cache, limits=None):
+    """
+    Takes the lines of a diff, a PatternSet, an LRUCache of the matches
+    found in blob changes, and optionally Limits. Yields each pattern,
+    file name, and line that match, like iter_matches, but only matches
+    a file's added lines the first time its blob change is seen; after
+    that, the cached matches are yielded for it instead.
+    """
+
+    for filename, blobs, added_lines in iter_file_diffs(lines, limits):
+        cached = blob_cache.get(blobs) if blobs else None
+        if cached is not None:
+            for pattern, match in cached:
+                yield pattern, filename, dict(match)
+            continue
+
+        file_matches, size = [], sys.getsizeof(blobs)
+        for pattern, _, match in iter_matches(added_lines, pattern_set):
+            file_matches.append((pattern, match))
+            size += sys.getsizeof(match) + sys.getsizeof(match["text"])
+            yield pattern, filename, dict(match)
+        if blobs:
+            blob_cache.put(blobs, file_matches, size)
+
+
+def group_matches(matches):
+    """
+    Takes matches, as yielded by iter_matches. Returns a dict of
+    each matching pattern to the files and lines that match it.
+    """
+
+    results = {}
+    for pattern, filename, match in matches:
+        files = results.setdefault(pattern, [])
+        if not files or files[-1]["file"] != filename:
+            files.append({"file": filename, "matches": []})
+        files[-1]["matches"].append(match)
+    return results
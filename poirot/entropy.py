@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+import math
+from collections import Counter
+from itertools import islice
+
+import regex
+
+from . import stats
+from .matcher import ENTROPY_PATTERN
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# runs of characters that make up tokens, keys and hashes
+TOKEN_RE = regex.compile(r"[A-Za-z0-9+/=_-]{20,}")
+HEX_RE = regex.compile(r"[0-9a-fA-F]+")
+# bits of entropy per character above which a token is reported, for
+# hexadecimal tokens and for the rest (base64-like, with a larger alphabet)
+HEX_THRESHOLD = 3.0
+BASE64_THRESHOLD = 4.5
+# number of added lines whose tokens are scored together
+BATCH_SIZE = 4096
+
+
+def score_tokens(tokens):
+    """
+    Returns the Shannon entropy, in bits per character, of each of a
+    list of ASCII tokens: with NumPy, all at once; otherwise one by one.
+    """
+
+    if not tokens:
+        return []
+    if numpy is None:
+        return score_tokens_python(tokens)
+    return score_tokens_numpy(tokens)
+
+
+def score_tokens_python(tokens):
+    scores = []
+    for token in tokens:
+        length = float(len(token))
+        scores.append(-sum(count / length * math.log(count / length, 2)
+                           for count in Counter(token).values()))
+    return scores
+
+
+def score_tokens_numpy(tokens):
+    """
+    Scores tokens from the counts of only the characters that occur in
+    each, so that memory grows with their total length rather than
+    with the size of the alphabet.
+    """
+
+    lengths = numpy.array([len(token) for token in tokens], dtype=numpy.int64)
+    chars = numpy.frombuffer("".join(tokens).encode("ascii"), dtype=numpy.uint8)
+    rows = numpy.repeat(numpy.arange(len(tokens), dtype=numpy.int64), lengths)
+    pairs, counts = numpy.unique(rows * 128 + chars, return_counts=True)  # each token's characters
+    pair_rows = pairs // 128
+    probabilities = counts / lengths[pair_rows].astype(float)
+    terms = -probabilities * numpy.log2(probabilities)
+    return numpy.bincount(pair_rows, weights=terms, minlength=len(tokens)).tolist()
+
+
+class EntropyDetector(object):
+    """
+    Finds tokens in added lines that look random (e.g. API keys with
+    no telltale prefix) by their Shannon entropy, reading the lines in
+    batches so that all their tokens are scored together.
+    """
+
+    def __init__(self, hex_threshold=HEX_THRESHOLD, base64_threshold=BASE64_THRESHOLD,
+                 batch_size=BATCH_SIZE):
+        self.hex_threshold = hex_threshold
+        self.base64_threshold = base64_threshold
+        self.batch_size = batch_size
+
+    def iter_hits(self, added_lines):
+        """
+        Takes added lines, as yielded by iter_added_lines. Yields each
+        of them along with a list of its high-entropy tokens, paired
+        with ENTROPY_PATTERN like PatternSet.search pairs patterns and
+        their matches.
+        """
+
+        added_lines = iter(added_lines)
+        while True:
+            batch = list(islice(added_lines, self.batch_size))
+            if not batch:
+                return
+
+            with stats.timed("entropy"):
+                tokens = [[match for match in TOKEN_RE.finditer(line, 1)] for _, _, line in batch]
+                found = [match for line_tokens in tokens for match in line_tokens]
+                scores = iter(score_tokens([match.group() for match in found]))
+                hits = []
+                for line_tokens in tokens:
+                    hits.append([(ENTROPY_PATTERN, match) for match in line_tokens
+                                 if next(scores) > self.threshold(match.group())])
+
+            for added, line_hits in zip(batch, hits):
+                yield added, line_hits
+
+    def threshold(self, token):
+        """
+        Returns the entropy above which token counts as random.
+        """
+
+        return self.hex_threshold if HEX_RE.fullmatch(token) else self.base64_threshold
@@ -66,17 +66,26 @@ def fail(text=""):
     return "%s %s" % (style(SYMBOL_CODES["fail"], "red"), text)
 
 
-def highlight(text, pattern):
+def highlight(text, pattern, span=None):
     """
-    Takes a string and highlights substrings matching a pattern
+    Takes a string and highlights the substring matching a pattern,
+    found at span (start, end) if it is given, rather than searched
+    for again
     """
 
+    if span:
+        start, end = span
+        if start < end:
+            return "%s%s%s" % (text[:start], style(text[start:end], "red"), text[end:])
+        return text
+
     pattern_re = regex.compile(pattern, regex.I)
     match = pattern_re.search(text)
     if match:
         text = text.replace(match.group(0), style(match.group(0), "red"))
     return text
 
+
 def strip(text):
     """Strips whitespace from end of line"""
 
@@ -94,8 +103,7 @@ def wrap(text, line_length, padding):
     word_list = [word.strip(" \n") for word in text.split(" ")]
     line = ""
     line_list = []
-    while len(word_list):
-        word = word_list.pop(0)
+    for word in word_list:
         if not line:
             if len(word) < line_length:
                 line = word
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+# uses async/await, and runs subprocesses on an event loop that is not
+# installed, so it is only imported (by GitBackend.run_all) on Python 3.8
+# and later
+
+import asyncio
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from . import stats
+
+
+async def run_git(git_dir, args, semaphore):
+    """
+    Executes a git command once semaphore lets it, and returns its
+    stdout as bytes.
+    """
+
+    async with semaphore:
+        stats.add_subprocess()
+        process = await asyncio.create_subprocess_exec(
+            "git", "--git-dir", git_dir, *args,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        (out, err) = await process.communicate()
+    stats.add_bytes_read(len(out))
+    return out
+
+
+def run_all(git_dir, queries, on_output, limit):
+    """
+    Executes a git command for each list of args in queries, up to
+    limit at once. Calls on_output with the index of each and its
+    stdout (as bytes) as soon as it finishes, one at a time on another
+    thread, so that the event loop keeps reading from the rest while
+    on_output runs.
+    """
+
+    async def run_query(index, args, semaphore, executor):
+        out = await run_git(git_dir, args, semaphore)
+        await loop.run_in_executor(executor, on_output, index, out)
+
+    async def run_queries(executor):
+        semaphore = asyncio.Semaphore(limit)
+        await asyncio.gather(*[run_query(index, args, semaphore, executor)
+                               for index, args in enumerate(queries)])
+
+    loop = asyncio.new_event_loop()
+    # a single thread, since on_output (e.g. reading diffs through the
+    # git backend's pipes) is not safe to run on several at once
+    executor = ThreadPoolExecutor(max_workers=1)
+    try:
+        loop.run_until_complete(run_queries(executor))
+    finally:
+        executor.shutdown()
+        loop.close()
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+
+import os
+import subprocess
+import sys
+
+from . import stats
+from .utils import execute_cmd, stream_cmd, to_text
+
+# a line that is not a commit, which git diff-tree --stdin echoes back
+# after the diff of the commit before it
+DIFF_END = b"POIROT-DIFF-END"
+# the most bytes of an object's contents read at once to skip past them
+SKIP_BYTES = 64 * 1024
+# the most git processes run_all runs at once, unless given
+GIT_JOBS = 8
+
+
+class ObjectReader(object):
+    """
+    Reads an object's contents (as bytes) from git cat-file's output,
+    no further than their end. Closing it skips past whatever was left
+    unread, so that the next object can be requested.
+    """
+
+    def __init__(self, stream, size):
+        self.stream = stream
+        self.left = size  # bytes of the contents not read from the stream yet
+        self.buffer = b""  # bytes read from the stream by peek but not returned yet
+        self.closed = False
+
+    def read_stream(self, read, size=-1):
+        """
+        Reads up to size bytes of the contents (or the rest of them,
+        if size is negative) from the stream with its method read.
+        """
+
+        data = read(self.left if size < 0 else min(size, self.left))
+        self.left -= len(data)
+        stats.add_bytes_read(len(data))
+        return data
+
+    def peek(self, size):
+        """
+        Returns the next size bytes of the contents, or fewer at their
+        end, without reading past them.
+        """
+
+        if len(self.buffer) < size:
+            self.buffer += self.read_stream(self.stream.read, size - len(self.buffer))
+        return self.buffer[:size]
+
+    def read(self):
+        """
+        Returns the rest of the contents.
+        """
+
+        data, self.buffer = self.buffer + self.read_stream(self.stream.read), b""
+        return data
+
+    def readline(self, size=-1):
+        """
+        Returns the next line of the contents, like a file's readline,
+        reading no more than size bytes of it if size is not negative.
+        """
+
+        if not self.buffer:
+            return self.read_stream(self.stream.readline, size)
+        end = self.buffer.find(b"\n") + 1 or len(self.buffer)
+        if size >= 0:
+            end = min(end, size)
+        line, self.buffer = self.buffer[:end], self.buffer[end:]
+        if self.buffer or line.endswith(b"\n") or len(line) == size:
+            return line
+        return line + self.readline(size - len(line) if size >= 0 else -1)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed, self.buffer = True, b""
+        while self.left and self.read_stream(self.stream.read, SKIP_BYTES):
+            pass
+        stats.add_bytes_read(len(self.stream.read(1)))  # the newline after the contents
+
+
+class GitBackend(object):
+    """
+    Runs git commands against a repository. Keeps a git diff-tree and
+    a git cat-file process open for the whole run, piping SHAs through
+    them instead of starting a new process for every commit.
+    """
+
+    def __init__(self, git_dir):
+        self.git_dir = git_dir
+        self.diff_tree = None
+        self.cat_file = None
+
+    def run(self, args, raw=False):
+        """
+        Executes a git command and returns its stdout and stderr, as
+        text or, if raw, as bytes.
+        """
+
+        return execute_cmd(["git", "--git-dir", self.git_dir] + list(args), raw=raw)
+
+    def run_all(self, queries, on_output, limit=GIT_JOBS):
+        """
+        Executes a git command for each list of args in queries, up to
+        limit at once on Python 3.8 and later, and one at a time before
+        that. Calls on_output with the index of each and its stdout (as
+        bytes) as soon as it finishes.
+        """
+
+        # before 3.8, asyncio can only run subprocesses on the installed
+        # event loop of the main thread, with a child watcher attached
+        if sys.version_info < (3, 8) or limit <= 1:
+            for index, args in enumerate(queries):
+                on_output(index, self.run(args, raw=True)[0])
+            return
+        from .gitasync import run_all
+        run_all(self.git_dir, queries, on_output, limit)
+
+    def stream(self, args, stdin=None, raw=False):
+        """
+        Executes a git command and yields its stdout line by line, as
+        text or, if raw, as bytes.
+        """
+
+        return stream_cmd(["git", "--git-dir", self.git_dir] + list(args), stdin=stdin, raw=raw)
+
+    def start(self, args):
+        """
+        Starts a long-lived git process reading from and writing to
+        pipes.
+        """
+
+        stats.add_subprocess()
+        with open(os.devnull, "w") as devnull:
+            return subprocess.Popen(["git", "--git-dir", self.git_dir] + list(args),
+                                    stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                    stderr=devnull)
+
+    def diff(self, sha):
+        """
+        Yields the lines (as bytes) of a commit's diff against its
+        parent, as git show would print them. The lines must be
+        consumed before the next request; otherwise they are skipped
+        over when the generator is closed.
+        """
+
+        if len(sha) != 40:  # diff-tree only reads full SHAs
+            sha = self.resolve(sha)
+            if sha is None:
+                return
+        if self.diff_tree is None:
+            self.diff_tree = self.start(["diff-tree", "--stdin", "-r", "-M", "--root",
+                                         "-p", "--no-color", "--unified=0", "--full-index"])
+        pipe = self.diff_tree
+        pipe.stdin.write(sha.encode("utf-8") + b"\n" + DIFF_END + b"\n")
+        pipe.stdin.flush()
+
+        finished = False
+        try:
+            for line in stats.timed_iter("read_git", iter(pipe.stdout.readline, b"")):
+                stats.add_bytes_read(len(line))
+                if line.rstrip(b"\n") == DIFF_END:
+                    finished = True
+                    break
+                yield line
+        finally:
+            if not finished:  # skip past what was left unread
+                for line in iter(pipe.stdout.readline, b""):
+                    if line.rstrip(b"\n") == DIFF_END:
+                        break
+
+    def read_object(self, sha):
+        """
+        Returns the type and contents (as bytes) of the object named
+        by sha, or None if there is no such object.
+        """
+
+        found = self.request_object(sha)
+        return found[1:] if found else None
+
+    def resolve(self, name):
+        """
+        Returns the full SHA of the object named by name (e.g. an
+        abbreviated SHA), or None if there is no such object.
+        """
+
+        found = self.request_object(name)
+        return found[0] if found else None
+
+    def request_object(self, name):
+        """
+        Returns the full SHA, type, and contents of the object named
+        by name, as read through git cat-file, or None if there is no
+        such object.
+        """
+
+        found = self.open_object(name)
+        if found is None:
+            return None
+        sha, object_type, reader = found
+        try:
+            with stats.timed("read_git"):
+                contents = reader.read()
+        finally:
+            reader.close()
+        return sha, object_type, contents
+
+    def open_object(self, name):
+        """
+        Requests the object named by name from git cat-file. Returns
+        its full SHA, its type, and an ObjectReader of its contents,
+        which must be closed before the next request, or None if there
+        is no such object.
+        """
+
+        if self.cat_file is None:
+            self.cat_file = self.start(["cat-file", "--batch"])
+        pipe = self.cat_file
+        with stats.timed("read_git"):
+            pipe.stdin.write("{}\n".format(name).encode("utf-8"))
+            pipe.stdin.flush()
+
+            header = pipe.stdout.readline()
+            stats.add_bytes_read(len(header))
+        header = to_text(header).split()
+        if len(header) != 3:  # <name> missing, or ambiguous
+            return None
+        return header[0], header[1], ObjectReader(pipe.stdout, int(header[2]))
+
+    def close(self):
+        """
+        Ends the long-lived git processes.
+        """
+
+        for pipe in (self.diff_tree, self.cat_file):
+            if pipe is not None:
+                pipe.stdin.close()
+                pipe.stdout.close()
+                pipe.wait()
+        self.diff_tree = None
+        self.cat_file = None
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+import sqlite3
+
+from .diffs import iter_added_lines
+from .matcher import fold
+from .utils import to_text
+
+INDEX_VERSION = 1
+# number of commits indexed between writes to disk, so that an interrupted
+# build keeps most of its progress
+COMMITS_PER_WRITE = 500
+
+
+def iter_trigrams(text):
+    """
+    Yields every run of three characters in text.
+    """
+
+    for i in range(len(text) - 2):
+        yield text[i:i + 3]
+
+
+class TrigramIndex(object):
+    """
+    Keeps, in an SQLite database, the trigrams of the (case-folded)
+    messages and added lines of each commit indexed. A pattern can
+    only match a commit that has all the trigrams of the literal the
+    pattern requires, so looking those up narrows a search of the
+    history down to the commits that could match it. Commits are
+    added as they are first searched, so the index grows with the
+    history.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS commits (id INTEGER PRIMARY KEY, sha TEXT UNIQUE);
+            CREATE TABLE IF NOT EXISTS trigrams (
+                trigram TEXT, commit_id INTEGER, PRIMARY KEY (trigram, commit_id)
+            ) WITHOUT ROWID;
+        """)
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row is None:
+            self.db.execute("INSERT INTO meta VALUES ('version', ?)", (str(INDEX_VERSION),))
+            self.db.commit()
+        elif row[0] != str(INDEX_VERSION):
+            raise IOError("{} was built by another version of Poirot; delete it to rebuild it"
+                          .format(path))
+
+    def missing(self, shas):
+        """
+        Returns the commits among shas (full SHAs) not indexed yet, in
+        the same order.
+        """
+
+        indexed = set(sha for sha, in self.db.execute("SELECT sha FROM commits"))
+        return [sha for sha in shas if sha not in indexed]
+
+    def add(self, shas, history):
+        """
+        Indexes the commits shas, given their history as yielded by
+        Poirot.read_history for them in the same order (whose logs
+        carry abbreviated SHAs).
+        """
+
+        shas, position, count = list(shas), 0, 0
+        for log, diff_lines in history:
+            while not shas[position].startswith(to_text(log[0])):
+                position += 1
+            trigrams = set(iter_trigrams(fold(to_text(log[-1]))))
+            for filename, line_num, line in iter_added_lines(diff_lines):
+                trigrams.update(iter_trigrams(fold(line[1:])))
+
+            commit_id = self.db.execute("INSERT INTO commits (sha) VALUES (?)",
+                                        (shas[position],)).lastrowid
+            self.db.executemany("INSERT OR IGNORE INTO trigrams VALUES (?, ?)",
+                                ((trigram, commit_id) for trigram in trigrams))
+            count += 1
+            if count % COMMITS_PER_WRITE == 0:
+                self.db.commit()
+        self.db.commit()
+
+    def lookup(self, literal):
+        """
+        Returns the SHAs of the indexed commits having every trigram
+        of a (case-folded) literal.
+        """
+
+        trigrams = sorted(set(iter_trigrams(literal)))
+        query = " INTERSECT ".join(["SELECT commit_id FROM trigrams WHERE trigram = ?"] * len(trigrams))
+        rows = self.db.execute("SELECT sha FROM commits WHERE id IN ({})".format(query), trigrams)
+        return set(sha for sha, in rows)
+
+    def candidates(self, shas, pattern_set):
+        """
+        Returns the commits among shas, all of which must be indexed,
+        that could match a pattern in pattern_set, in the same order.
+        Returns all of them if any pattern doesn't require a literal
+        of at least three characters, or with an entropy detector.
+        """
+
+        literals = set(pattern_set.literals.values())
+        if pattern_set.detector or pattern_set.unfiltered or any(len(l) < 3 for l in literals):
+            return list(shas)
+
+        found = set()
+        for literal in literals:
+            found.update(self.lookup(literal))
+        return [sha for sha in shas if sha in found]
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import sys
+
+import regex
+
+from . import stats
+from .filters import style
+
+try:
+    RegexTimeout = TimeoutError
+except NameError:  # Python 2
+    RegexTimeout = RuntimeError
+
+# escapes whose meaning runs past the next character, so that a
+# literal can't be read off after them
+LONG_ESCAPES = set("xuUNpPgko0123456789")
+# group openings that don't change how the rest of a pattern is read
+PLAIN_GROUPS = (":", "=", "!", "<=", "<!", ">", "#", "|")
+QUANTIFIER_RE = regex.compile(r"\{([0-9]*)(,[0-9]*)?\}")
+# the key high-entropy strings are reported under with --entropy, like a
+# pattern's, and its description
+ENTROPY_PATTERN = "<high entropy string>"
+ENTROPY_LABEL = "High-entropy strings (e.g. random API keys and tokens)"
+# the longest a pattern may take to search a single line, in seconds
+REGEX_TIMEOUT = 1.0
+# patterns taking longer than this to search the whole profiling corpus are flagged as slow
+SLOW_PATTERN_SECONDS = 0.05
+# lines that make badly written patterns backtrack: long runs of repeated
+# characters and separators, and minified code
+PROFILE_CORPUS = [
+    "a" * 4000,
+    "0" * 4000,
+    " " * 4000 + "x",
+    "a=" * 2000,
+    "a:" * 2000,
+    "password = " + "x" * 4000,
+    "var a={" + ",".join('"k{0}":"v{0}"'.format(i) for i in range(300)) + "};",
+    "<div class=\"a\">" * 250,
+]
+
+
+def fold(text):
+    """
+    Case-folds text so that it can be compared with the literals
+    required by case-insensitive patterns.
+    """
+
+    try:
+        return text.casefold()
+    except AttributeError:  # Python 2 strings have no casefold
+        return text.lower()
+
+
+def required_literal(pattern):
+    """
+    Returns the longest run of ASCII literal characters (case-folded)
+    that every match of a pattern must contain, or None if there is
+    no such run or the pattern is too involved to read one off.
+    """
+
+    def skip_set(i):
+        """Returns the index after the character set opening at i"""
+
+        i += 1
+        if pattern[i:i + 1] == "^":
+            i += 1
+        if pattern[i:i + 1] == "]":
+            i += 1
+        while i < len(pattern):
+            if pattern[i] == "\\":
+                i += 2
+            elif pattern.startswith("[:", i):
+                end = pattern.find(":]", i + 2)
+                i = end + 2 if end > -1 else i + 1
+            elif pattern[i] == "]":
+                return i + 1
+            else:
+                i += 1
+        raise ValueError("unterminated character set")
+
+    def skip_group(i):
+        """Returns the index after the group opening at i"""
+
+        if pattern.startswith("(?", i) and not pattern.startswith(PLAIN_GROUPS, i + 2):
+            raise ValueError("group may set flags")
+        depth = 0
+        while i < len(pattern):
+            if pattern[i] == "\\":
+                i += 2
+                continue
+            elif pattern[i] == "[":
+                i = skip_set(i)
+                continue
+            elif pattern[i] == "(":
+                depth += 1
+            elif pattern[i] == ")":
+                depth -= 1
+                if not depth:
+                    return i + 1
+            i += 1
+        raise ValueError("unterminated group")
+
+    runs, run, i = [], "", 0
+    try:
+        while i < len(pattern):
+            char, atom = pattern[i], None
+            if char == "\\":
+                escaped = pattern[i + 1:i + 2]
+                if not escaped or escaped in LONG_ESCAPES:
+                    return None
+                if not escaped.isalnum():
+                    atom = escaped
+                i += 2
+            elif char == "[":
+                i = skip_set(i)
+            elif char == "(":
+                i = skip_group(i)
+            elif char == "|":
+                return None  # any one alternative may match instead
+            elif char in "*+?{)":
+                return None  # nothing to repeat or close, so leave it to regex
+            else:
+                if char not in ".^$":
+                    atom = char
+                i += 1
+
+            if atom is not None and ord(atom) > 127:
+                atom = None
+
+            # look for a quantifier applying to the atom
+            repeat = pattern[i:i + 1]
+            minimum = 1
+            if repeat in ("*", "?"):
+                minimum, i = 0, i + 1
+            elif repeat == "+":
+                i += 1
+            elif repeat == "{":
+                quantifier = QUANTIFIER_RE.match(pattern, i)
+                if not quantifier:
+                    return None
+                minimum = int(quantifier.group(1) or 0)
+                i = quantifier.end()
+            if repeat and repeat in "*?+{":
+                if pattern[i:i + 1] in ("?", "+"):  # lazy or possessive
+                    i += 1
+                if atom is not None and minimum:
+                    run += atom
+                runs.append(run)
+                run = ""
+            elif atom is not None:
+                run += atom
+            else:
+                runs.append(run)
+                run = ""
+    except ValueError:
+        return None
+    runs.append(run)
+
+    literal = max(runs, key=len)
+    return fold(literal) if literal else None
+
+
+def profile_pattern(pattern, timeout=REGEX_TIMEOUT):
+    """
+    Times a case-insensitive pattern searching PROFILE_CORPUS. Returns
+    the seconds taken, or None if it took longer than timeout to
+    search any one line. Raises regex.error if the pattern is invalid.
+    """
+
+    compiled = regex.compile(pattern, regex.I)
+    start = stats.clock()
+    for line in PROFILE_CORPUS:
+        try:
+            compiled.search(line, timeout=timeout)
+        except RegexTimeout:
+            return None
+    return stats.clock() - start
+
+
+def compile_patterns(info):
+    """
+    Returns the PatternSet for the patterns in a search's options,
+    with an EntropyDetector if --entropy was given.
+    """
+
+    detector = None
+    if info["entropy"]:
+        from .entropy import EntropyDetector  # loads NumPy, if installed
+
+        detector = EntropyDetector()
+    patterns = [pattern for pattern in info["patterns"] if pattern != ENTROPY_PATTERN]
+    return PatternSet(patterns, info["regex_timeout"], detector)
+
+
+class PatternSet(object):
+    """
+    Compiles a set of case-insensitive text patterns once and tests
+    text against all of them, first screening it for the literal
+    substrings the patterns require so that the regular expressions
+    only run on text that could match them. A pattern that takes
+    longer than timeout seconds to search some text is given up on
+    for that text. With an EntropyDetector, the high-entropy strings
+    in diffs' added lines are matched too, under ENTROPY_PATTERN.
+    """
+
+    def __init__(self, patterns, timeout=REGEX_TIMEOUT, detector=None):
+        self.patterns = list(patterns)
+        self.detector = detector
+        self.keys = self.patterns + ([ENTROPY_PATTERN] if detector else [])
+        self.timeout = timeout or None
+        self.timeouts = {}
+        self.regexes = {}
+        self.message_regexes = {}
+        self.literals = {}
+        self.unfiltered = []
+
+        for pattern in self.patterns:
+            self.regexes[pattern] = regex.compile(pattern, regex.I)
+            self.message_regexes[pattern] = regex.compile(pattern, regex.I | regex.M)
+            literal = required_literal(pattern)
+            if literal:
+                self.literals[pattern] = literal
+            else:
+                self.unfiltered.append(pattern)
+
+        literals = sorted(set(self.literals.values()), key=len, reverse=True)
+        self.prefilter = None
+        if literals:
+            self.prefilter = regex.compile("|".join(regex.escape(l) for l in literals))
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def candidates(self, text):
+        """
+        Returns the patterns that text could match: those whose
+        required literal it contains, and those without one.
+        """
+
+        folded = fold(text)
+        if self.prefilter is None or not self.prefilter.search(folded):
+            return self.unfiltered
+        candidates = [p for p, literal in self.literals.items() if literal in folded]
+        return candidates + self.unfiltered if self.unfiltered else candidates
+
+    def search(self, line):
+        """
+        Returns each pattern matching a line, paired with its match.
+        """
+
+        if stats.collector is not None:
+            stats.collector.lines_scanned += 1
+            return self.timed_search(line, self.regexes)
+
+        hits = []
+        for pattern in self.candidates(line):
+            match = self.run(self.regexes, pattern, line)
+            if match:
+                hits.append((pattern, match))
+        return hits
+
+    def search_message(self, message):
+        """
+        Returns each pattern matching any line of a commit message,
+        paired with its match.
+        """
+
+        if stats.collector is not None:
+            stats.collector.messages_scanned += 1
+            return self.timed_search(message, self.message_regexes)
+
+        hits = []
+        for pattern in self.candidates(message):
+            match = self.run(self.message_regexes, pattern, message)
+            if match:
+                hits.append((pattern, match))
+        return hits
+
+    def timed_search(self, text, regexes):
+        """
+        Searches text like search does, with the given compiled
+        patterns, adding the time spent screening it and running each
+        pattern to the stats being collected.
+        """
+
+        collector = stats.collector
+        start = stats.clock()
+        candidates = self.candidates(text)
+        collector.add_step("prefilter", stats.clock() - start)
+
+        hits = []
+        for pattern in candidates:
+            start = stats.clock()
+            match = self.run(regexes, pattern, text)
+            collector.add_pattern(pattern, stats.clock() - start, match is not None)
+            if match:
+                hits.append((pattern, match))
+        return hits
+
+    def run(self, regexes, pattern, text):
+        """
+        Searches text with a pattern's compiled regular expression
+        from regexes. Returns None if it times out, warning about the
+        pattern the first time it does.
+        """
+
+        try:
+            return regexes[pattern].search(text, timeout=self.timeout)
+        except RegexTimeout:
+            self.timeouts[pattern] = self.timeouts.get(pattern, 0) + 1
+            if self.timeouts[pattern] == 1:
+                out = "Pattern {} took longer than {}s to search a line of {} characters, so it was skipped"
+                print(style(out.format(pattern, self.timeout, len(text)), "red"), file=sys.stderr)
+            return None
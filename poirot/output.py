@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import json
+
+AUTHOR_FIELDS = ("author_name", "author_email", "author_date")
+# the indent of the --output JSON
+JSON_INDENT = 4
+
+
+def dump_json(value, depth=0):
+    """
+    Returns value as indented JSON, as it would appear nested depth
+    levels deep in a larger document.
+    """
+
+    text = json.dumps(value, ensure_ascii=False, indent=JSON_INDENT, separators=(",", ": "))
+    return text.replace("\n", "\n" + " " * JSON_INDENT * depth)
+
+
+def write_json(results, outfile, extra=None):
+    """
+    Writes results (a mapping of each pattern to a mapping of the
+    commits matching it to their metadata), followed by the items of
+    the dict extra, as a JSON object laid out as json.dump would with
+    JSON_INDENT. Reads and writes one commit at a time, so that the
+    results are never copied whole.
+    """
+
+    def write_key(key, written, depth):
+        outfile.write(",\n" if written else "\n")
+        outfile.write(" " * JSON_INDENT * depth + dump_json(key) + ": ")
+
+    outfile.write("{")
+    written = False
+    for pattern, commits in results.items():
+        write_key(pattern, written, 1)
+        outfile.write("{")
+        found = False
+        for commit, metadata in commits.items():
+            write_key(commit, found, 2)
+            outfile.write(dump_json(metadata, 2))
+            found = True
+        outfile.write("\n" + " " * JSON_INDENT + "}" if found else "}")
+        written = True
+    for key, value in (extra or {}).items():
+        write_key(key, written, 1)
+        outfile.write(dump_json(value, 1))
+        written = True
+    outfile.write("\n}" if written else "}")
+
+
+class NDJSONWriter(object):
+    """
+    Writes results as newline-delimited JSON, one record per match,
+    as soon as they are found.
+    """
+
+    def __init__(self, path=None):
+        self.outfile = open(path, "w") if path else sys.stdout
+        self.count = 0
+
+    def write(self, pattern, commit, metadata):
+        """
+        Writes a record for each match in a commit's metadata (its
+        message and file lines matching the pattern) and flushes them.
+        """
+
+        record = {"pattern": pattern, "commit": commit}
+        for field in AUTHOR_FIELDS:
+            if field in metadata:
+                record[field] = metadata[field]
+
+        if "message" in metadata:
+            message = dict(record, message=metadata["message"])
+            if "message_span" in metadata:
+                message["span"] = metadata["message_span"]
+            self.write_record(message)
+            self.count += 1
+        for file_diff in metadata.get("files", []):
+            for match in file_diff["matches"]:
+                self.write_record(dict(record, file=file_diff["file"], **match))
+                self.count += 1
+        self.outfile.flush()
+
+    def write_record(self, record):
+        """
+        Writes a record, which counts as a match only when written by
+        write.
+        """
+
+        self.outfile.write(json.dumps(record, ensure_ascii=False, sort_keys=True) + "\n")
+
+    def close(self):
+        if self.outfile is not sys.stdout:
+            self.outfile.close()
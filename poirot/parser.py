@@ -7,11 +7,17 @@ import sys
 from argparse import ArgumentParser
 
 import regex
-import requests
 
 from .filters import style
+from .gitio import GIT_JOBS
+from .matcher import (ENTROPY_LABEL, ENTROPY_PATTERN, REGEX_TIMEOUT, SLOW_PATTERN_SECONDS,
+                      profile_pattern)
 from .utils import merge_dicts
 
+# the verdicts of check_pattern, so that a process loading the same
+# patterns again (e.g. poirot-daemon) profiles each only once
+checked_patterns = {}
+
 
 def parse_arguments(args):
     query = ArgumentParser(prog="poirot", description="""Poirot: Mind Your Language""")
@@ -31,6 +37,13 @@ def parse_arguments(args):
                                of file paths.""")
     query.add_argument("--output", "-o", dest="output", required=False,
                        help="""Output results as JSON to FILE.""")
+    query.add_argument("--output-format", "-of", dest="output_format", default="json",
+                       choices=["json", "ndjson"],
+                       help="""The format of the --output file: 'json' (the
+                               default) writes all results at the end of the
+                               search; 'ndjson' writes one JSON record per
+                               match as soon as it is found, to standard
+                               output if no --output is given.""")
     query.add_argument("--revlist", "-rl", dest="revlist", required=False, default="HEAD^!",
                        help="""A comma-delimited list of revision (commit)
                                ranges to search. Defaults to HEAD^!. Specify
@@ -45,6 +58,64 @@ def parse_arguments(args):
     query.add_argument("--staged", "-st", dest="staged", action="store_true",
                        help="""Flag to search staged modifications, instead of
                                already committed ones.""")
+    query.add_argument("--tree", "-tr", dest="tree", nargs="?", const="", default=None,
+                       help="""Search every file in the tree of a revision
+                               (e.g. HEAD), or in the working tree if none is
+                               given, instead of the revision history. Binary
+                               files are skipped.""")
+    query.add_argument("--state", "-s", dest="state", nargs="?", const="", default=None,
+                       help="""Keep track of the commits already scanned (and
+                               what was found in them) in a STATE file, so
+                               later runs only scan new commits. Defaults to
+                               poirot_state.json in the .git directory.""")
+    query.add_argument("--index", "-i", dest="index", nargs="?", const="", default=None,
+                       help="""Keep an index of the trigrams in each commit's
+                               message and added lines in an INDEX file (built
+                               as commits are first searched), and only search
+                               the commits the index says could match. Defaults
+                               to poirot_index.sqlite in the .git directory.""")
+    query.add_argument("--jobs", "-j", dest="jobs", type=int, default=1,
+                       help="""The number of processes to scan the revision
+                               history with. Defaults to 1.""")
+    query.add_argument("--git-jobs", "-gj", dest="git_jobs", type=int, default=GIT_JOBS,
+                       help="""The most git logs to run at once when each
+                               pattern is searched for on its own (as
+                               Poirot.search does), one per revision range
+                               and target. Defaults to 8.""")
+    query.add_argument("--regex-timeout", "-rt", dest="regex_timeout", type=float,
+                       default=REGEX_TIMEOUT,
+                       help="""The longest, in seconds, a pattern may take to
+                               search a line before it is skipped for that
+                               line. Patterns timing out on the lines they
+                               are profiled against when loaded are left out.
+                               Defaults to 1; 0 turns both checks off.""")
+    query.add_argument("--cache-ttl", "-ct", dest="cache_ttl", type=float, default=None,
+                       help="""The number of seconds to use cached copies of
+                               remote pattern files before checking them for
+                               changes. Defaults to an hour.""")
+    query.add_argument("--offline", dest="offline", action="store_true",
+                       help="""Flag to use cached copies of remote pattern
+                               files, however old, without fetching them.""")
+    query.add_argument("--max-diff-size", "-mds", dest="max_diff_size", type=int, default=None,
+                       help="""The most characters of a file's added lines to
+                               search in each commit (or of each file, with
+                               --tree); the rest of the file is skipped.""")
+    query.add_argument("--max-line-length", "-mll", dest="max_line_length", type=int,
+                       default=None,
+                       help="""The most characters of a line to search; longer
+                               lines (e.g. minified code) are cut short.""")
+    query.add_argument("--exclude", "-x", dest="exclude", default="",
+                       help="""A comma-separated list of globs (e.g.
+                               'vendor/*,*.min.js') matching the paths of
+                               files not to search.""")
+    query.add_argument("--entropy", dest="entropy", action="store_true",
+                       help="""Flag to also search added lines for strings
+                               random enough to be keys or tokens, whatever
+                               their format.""")
+    query.add_argument("--stats", dest="stats", action="store_true",
+                       help="""Flag to report the time spent in git and in
+                               matching each pattern, the git processes run,
+                               and the bytes and lines read.""")
     query.add_argument("--verbose", "-v", dest="verbose", action="store_true",
                        help="""Flag to output colorful, verbose results.""")
 
@@ -54,19 +125,24 @@ def parse_arguments(args):
     return formatted_args
 
 
-def parse_patterns(path):
+def parse_patterns(path, timeout=REGEX_TIMEOUT, fetched=None):
     """
-    Reads in patterns from pattern file at path
+    Reads in patterns from pattern file at path, leaving out any
+    that check_pattern rejects (unless timeout is 0). A remote
+    pattern file is read from fetched, a dict of the remote files
+    already fetched, if given
     """
 
     result = {}
     try:
-        if regex.search(r"^http[s]://", path):
-            response = requests.get(path)
-            if response.status_code == 200:
-                lines = response.text.split("\n")
-            else:
-                sys.exit(1)
+        if is_remote(path):
+            if fetched is None:
+                from .remote import PatternFileCache
+
+                fetched = PatternFileCache().fetch_all([path])
+            if fetched.get(path) is None:  # couldn't be fetched, as already printed
+                return result
+            lines = fetched[path].split("\n")
         else:
             with open(path) as infile:
                 lines = infile.readlines()
@@ -83,9 +159,53 @@ def parse_patterns(path):
         out = """Pattern file {file} does not exist.\n
                  Specify the correct path with --patterns""".format(file=path)
         print(style(out, "red"))
+    if timeout:
+        result = {pattern: label for pattern, label in result.items()
+                  if check_pattern(pattern, timeout)}
     return result
 
 
+def is_remote(path):
+    """Checks whether a pattern file's path is a URL"""
+
+    return regex.match(r"https?://", path) is not None
+
+
+def check_pattern(pattern, timeout=REGEX_TIMEOUT):
+    """
+    Profiles a pattern, warning if it is slow to match. Returns False
+    if it is not a valid regular expression or takes longer than
+    timeout to search a line of the profiling corpus, else True.
+    """
+
+    if (pattern, timeout) not in checked_patterns:
+        checked_patterns[(pattern, timeout)] = profile_and_warn(pattern, timeout)
+    return checked_patterns[(pattern, timeout)]
+
+
+def profile_and_warn(pattern, timeout):
+    """
+    Profiles a pattern for check_pattern, printing any warnings.
+    """
+
+    try:
+        seconds = profile_pattern(pattern, timeout)
+    except regex.error as error:
+        out = "Leaving out pattern {}, which is not a valid regular expression: {}"
+        print(style(out.format(pattern, error), "red"), file=sys.stderr)
+        return False
+    if seconds is None:
+        out = """Leaving out pattern {}, which took longer than {}s to search
+                 a long line. Nested or adjacent unbounded repeats, like
+                 (.+)=(.+), can make it backtrack catastrophically.""".format(pattern, timeout)
+        print(style(out, "red"), file=sys.stderr)
+        return False
+    if seconds > SLOW_PATTERN_SECONDS:
+        out = "Pattern {} is slow to match ({:.3f}s to search the profiling corpus)"
+        print(style(out.format(pattern, seconds), "yellow"), file=sys.stderr)
+    return True
+
+
 def format_arguments(args):
     """Cleans up arguments passed to argparse"""
 
@@ -97,21 +217,39 @@ def format_arguments(args):
 
     def format_patterns():
         patterns = {}
-        if args.term:
+        if args.term and check_pattern(args.term, args.regex_timeout):
             patterns[args.term] = None
         try:
             file_list = [path.strip() for path in args.patterns.split(",") if path.strip()]
+            fetched = {}
+            if any(is_remote(path) for path in file_list):
+                from .remote import PatternFileCache
+
+                cache = PatternFileCache(ttl=args.cache_ttl, offline=args.offline)
+                fetched = cache.fetch_all([path for path in file_list if is_remote(path)])
             for path in file_list:
-                patterns = merge_dicts(patterns, parse_patterns(path))
+                patterns = merge_dicts(patterns, parse_patterns(path, args.regex_timeout, fetched))
         except AttributeError:
             pass
         if not patterns:
-            print("No patterns given! Using default pattern set.")
+            print("No patterns given! Using default pattern set.", file=sys.stderr)
             file_dir = os.path.dirname(os.path.realpath(__file__))
             default_file = os.path.join(file_dir, "patterns/default.txt")
-            patterns = merge_dicts(patterns, parse_patterns(default_file))
+            patterns = merge_dicts(patterns, parse_patterns(default_file, args.regex_timeout))
+        if args.entropy:
+            patterns[ENTROPY_PATTERN] = ENTROPY_LABEL
         return patterns
 
+    def format_state():
+        if args.state == "":
+            return os.path.join(args.dir, ".git", "poirot_state.json")
+        return args.state
+
+    def format_index():
+        if args.index == "":
+            return os.path.join(args.dir, ".git", "poirot_index.sqlite")
+        return args.index
+
     return {
         "before": args.before,
         "after": args.after,
@@ -119,10 +257,24 @@ def format_arguments(args):
         "verbose": args.verbose,
         "dir": args.dir,
         "staged": args.staged,
+        "tree": args.tree,
         "git_dir": args.dir + "/.git",
         "repo_dir": args.dir,
         "revlist": format_revlist(),
         "git_url": args.url.rstrip("/"),
         "patterns": format_patterns(),
-        "output": args.output
+        "output": args.output,
+        "output_format": args.output_format,
+        "state": format_state(),
+        "index": format_index(),
+        "jobs": max(1, args.jobs),
+        "git_jobs": max(1, args.git_jobs),
+        "stats": args.stats,
+        "entropy": args.entropy,
+        "max_diff_size": args.max_diff_size,
+        "max_line_length": args.max_line_length,
+        "exclude": [glob.strip() for glob in args.exclude.split(",") if glob.strip()],
+        "regex_timeout": max(0, args.regex_timeout),
+        "cache_ttl": args.cache_ttl,
+        "offline": args.offline
     }
@@ -3,38 +3,148 @@
 from __future__ import print_function
 
 import sys
-import json
-
-import regex
-from tqdm import tqdm
+from collections import Counter
+from itertools import groupby
 
+from . import stats
+from .diffs import Limits, group_matches, iter_added_lines, iter_blob_matches, iter_matches
 from .filters import style
-from .utils import clone_pull, execute_cmd, is_git_dir, utf8_decode
+from .gitio import GitBackend
+from .matcher import PatternSet, compile_patterns
+from .output import NDJSONWriter, write_json
+from .utils import LRUCache, clone_pull, is_git_dir, stream_cmd, to_text, utf8_decode
 from .parser import parse_arguments
-from .clients import render
+from .results import ResultStore
+
+# upper bound on the memory used to keep commits' split diffs between patterns
+DIFF_CACHE_BYTES = 64 * 1024 * 1024
+# upper bound on the memory used to remember the matches in blob changes already scanned
+BLOB_CACHE_BYTES = 32 * 1024 * 1024
+# diff cache key for the staged changes, which no commit SHA can collide with
+STAGED_KEY = "staged"
+# results key for the matches in a snapshot of the tree (with --tree)
+TREE_KEY = "tree"
+# number of files per shard when scanning a tree with --jobs
+FILES_PER_SHARD = 64
+# the fields of a commit's log, as git formats them: its abbreviated SHA,
+# the date, name, and email of its author, and its message. They are
+# separated by NULs, which can't appear in any of them.
+LOG_FIELDS = ["%h", "%aD", "%an", "%ae", "%s %b"]
+# number of shards per process when scanning with --jobs, to even out their load
+SHARDS_PER_JOB = 4
+# the PatternSet of a --jobs worker process, compiled once when it starts,
+# the matches it has found in blob changes, and its Limits
+worker_pattern_set = None
+worker_blob_cache = None
+worker_limits = None
 
 
 def main(args=sys.argv[1:], render_results=True, skip_clone_pull=False):
     investigator = Poirot(args, render_results, skip_clone_pull)
 
-    for pattern in tqdm(investigator.info["patterns"]):
-        investigator.search(utf8_decode(pattern))
+    investigator.search_all()
+    investigator.git.close()
 
     return investigator.get_results()
 
 
+def init_worker(info):
+    """
+    Compiles the patterns for a --jobs worker process
+    """
+
+    global worker_pattern_set, worker_blob_cache, worker_limits
+    stats.enable(info["stats"])
+    worker_pattern_set = compile_patterns(info)
+    worker_blob_cache = LRUCache(BLOB_CACHE_BYTES)
+    worker_limits = Limits(info["max_diff_size"], info["max_line_length"], info["exclude"])
+
+
+def scan_shard(shard):
+    """
+    Scans a shard of commits, given by their SHAs, in a --jobs worker
+    process. Returns the results found in them, the counts of what was
+    skipped, and the stats collected while scanning them if --stats was
+    given.
+    """
+
+    git_dir, shas = shard
+    args = Poirot.get_history_args(["--no-walk=unsorted", "--stdin"])
+    lines = GitBackend(git_dir).stream(args, stdin="\n".join(shas) + "\n", raw=True)
+    history = Poirot.read_history(lines)
+    results = list(Poirot.iter_history_results(history, worker_pattern_set, worker_blob_cache,
+                                               worker_limits))
+    return results, worker_limits.drain(), stats.drain()
+
+
+def scan_tree_shard(shard):
+    """
+    Scans a shard of a tree's files, given as by list_files, in a
+    --jobs worker process. Returns the matches found in them, the counts
+    of what was skipped, and the stats collected while scanning them if
+    --stats was given.
+    """
+
+    from .tree import iter_tree_matches
+
+    git_dir, repo_dir, files = shard
+    git = GitBackend(git_dir)
+    try:
+        matches = list(iter_tree_matches(files, repo_dir, git, worker_pattern_set, worker_limits))
+    finally:
+        git.close()
+    return matches, worker_limits.drain(), stats.drain()
+
+
 class Poirot(object):
-    def __init__(self, args, render_results=True, skip_clone_pull=True):
+    def __init__(self, args, render_results=True, skip_clone_pull=True, info=None, pattern_set=None):
         self.render_results = render_results
-        self.info = parse_arguments(args)
-        self.results = {utf8_decode(p): {} for p in self.info["patterns"]}
-
-        if self.info["staged"]:
+        self.info = info if info is not None else parse_arguments(args)
+        stats.enable(self.info["stats"])
+        self.store = ResultStore(utf8_decode(p) for p in self.info["patterns"])
+        # a mapping of each pattern to the commits (or staged changes, or
+        # tree) matching it and their metadata, read from the store
+        self.results = self.store.view()
+        self.pattern_set = pattern_set or compile_patterns(self.info)
+        self.limits = Limits(self.info["max_diff_size"], self.info["max_line_length"],
+                             self.info["exclude"])
+        self.state = None
+        if self.info["state"] and not self.info["staged"] and self.info["tree"] is None:
+            from .state import ScanState, scan_key
+
+            self.state = ScanState(self.info["state"], scan_key(self.info))
+        self.index = None
+        if self.info["index"] and not self.info["staged"] and self.info["tree"] is None:
+            from .index import TrigramIndex
+
+            self.index = TrigramIndex(self.info["index"])
+        self.diff_cache = LRUCache(DIFF_CACHE_BYTES)
+        self.blob_cache = LRUCache(BLOB_CACHE_BYTES)
+        self.git = GitBackend(self.info["git_dir"])
+        self.writer = None
+        if self.info["output_format"] == "ndjson":
+            self.writer = NDJSONWriter(self.info["output"])
+
+        if self.info["staged"] or self.info["tree"] == "":
             is_git_dir(self.info["git_dir"])
         elif self.info["git_url"] and not skip_clone_pull:
             clone_pull(self.info["git_url"], self.info["repo_dir"])
 
 
+    def search_all(self):
+        """
+        Delegates to add_all_staged_results, search_tree, or
+        search_history to search for every pattern at once
+        """
+
+        if self.info["staged"]:
+            self.add_all_staged_results()
+        elif self.info["tree"] is not None:
+            self.search_tree()
+        else:
+            self.search_history()
+
+
     def search(self, pattern):
         """
         Delegates to add_staged_results or add_committed_results
@@ -52,7 +162,20 @@ class Poirot(object):
         """
 
         result = self.search_staged(pattern)
-        self.results[pattern] = {"staged": {"files": result}} if result else {}
+        if result:
+            self.add_result(pattern, "staged", {"files": result})
+
+
+    def add_all_staged_results(self):
+        """
+        Adds staged matches for every pattern to results, reading
+        the staged diff a single time
+        """
+
+        matches = group_matches(iter_matches(self.iter_staged_diff(), self.pattern_set))
+        for pattern in self.pattern_set.keys:
+            if pattern in matches:
+                self.add_result(pattern, "staged", {"files": matches[pattern]})
 
 
     def search_staged(self, pattern):
@@ -62,101 +185,505 @@ class Poirot(object):
         a staged revision.
         """
 
+        pattern_set = PatternSet([pattern], self.info["regex_timeout"])
+        matches = group_matches(iter_matches(self.iter_staged_diff(), pattern_set))
+        return matches.get(pattern, [])
+
+
+    def search_tree(self):
+        """
+        Searches every file in the tree of the --tree revision, or in
+        the working tree if none was given, for every pattern at once.
+        Adds matches to results under TREE_KEY, in the same form as
+        add_all_staged_results.
+        """
+
+        from .tree import iter_tree_matches, list_files
+
+        files = list_files(self.git, self.info["repo_dir"], self.info["tree"])
+        if self.info["jobs"] > 1:
+            tree_matches = self.search_tree_parallel(files)
+        else:
+            from tqdm import tqdm
+
+            tree_matches = iter_tree_matches(tqdm(files, unit=" files"), self.info["repo_dir"],
+                                             self.git, self.pattern_set, self.limits)
+
+        matches = group_matches(tree_matches)
+        for pattern in self.pattern_set.keys:
+            if pattern in matches:
+                self.add_result(pattern, TREE_KEY, {"files": matches[pattern]})
+
+
+    def search_tree_parallel(self, files):
+        """
+        Splits a tree's files into shards and scans them on a pool of
+        --jobs processes. Yields each pattern, file name, and line that
+        match, in the same order as a single process would find them.
+        """
+
+        shards = [(self.info["git_dir"], self.info["repo_dir"], files[i:i + FILES_PER_SHARD])
+                  for i in range(0, len(files), FILES_PER_SHARD)]
+
+        import multiprocessing
+        from tqdm import tqdm
+
+        pool = multiprocessing.Pool(self.info["jobs"], init_worker, (self.info,))
+        try:
+            for shard_matches, skipped, shard_stats in tqdm(pool.imap(scan_tree_shard, shards),
+                                                            total=len(shards), unit=" shards"):
+                self.limits.merge(skipped)
+                if shard_stats:
+                    stats.collector.merge(shard_stats)
+                for match in shard_matches:
+                    yield match
+        finally:
+            pool.close()
+            pool.join()
+
+
+    def iter_staged_diff(self):
+        """
+        Yields the added lines of the staged diff, running git diff
+        only the first time they are requested.
+        """
+
         cmd = ["git", "diff", "--staged", "--unified=0", "--",
                self.info["repo_dir"]]
-        (out, err) = execute_cmd(cmd)
-        return self.parse_diff(diff=out, pattern=pattern)
+        return self.iter_cached_diff(STAGED_KEY, lambda: stream_cmd(cmd, raw=True))
 
 
     def add_committed_results(self, pattern):
         """
-        Adds committed matches (logs, messages) to results
+        Adds committed matches (logs, messages) to results. Runs the
+        git log for each revision range and target, up to git_jobs at
+        once, reading each as soon as it finishes, then adds their
+        matches in order: each range's diffs, then its messages.
         """
 
-        def merge_committed(target, commit_range):
+        queries = [(target, commit_range) for commit_range in self.info["revlist"]
+                   for target in ("diff", "message")]
+        found = [None] * len(queries)
+
+        def read_output(index, out):
             """
             Reads in yielded commit sha and pattern match information from
-            search_committed. Adds to pattern matches for for the particular
-            commit.
+            search_committed for a finished git log.
             """
 
-            for commit, metadata in self.search_committed(target, pattern, commit_range):
-                self.results[pattern].setdefault(commit, {}).update(metadata)
+            target, commit_range = queries[index]
+            logs = self.split_logs(out)
+            found[index] = list(self.search_committed(target, pattern, commit_range, logs))
 
-        for commit_range in self.info["revlist"]:
-            merge_committed("diff", commit_range)
-            merge_committed("message", commit_range)
+        with stats.timed("get_logs"):
+            self.git.run_all([self.get_logs_args(target, pattern, commit_range)
+                              for target, commit_range in queries], read_output,
+                             self.info["git_jobs"])
+        for committed in found:
+            for commit, metadata in committed:
+                self.add_result(pattern, commit, metadata)
 
 
-    def search_committed(self, target, pattern, commit_range):
+    def search_committed(self, target, pattern, commit_range, logs=None):
         """
         Searches within a range of commits for commit messages or diffs
         containing the text pattern. Yields a matching revision's SHA
         and the message or file name, line number, text matching the
-        given pattern, and authorship.
+        given pattern, and authorship. Takes the output of get_logs,
+        if it has already been read.
         """
 
-        for log in self.get_logs(target, pattern, commit_range):
+        if logs is None:
+            logs = self.get_logs(target, pattern, commit_range)
+        for log in logs:
             sha, metadata = self.parse_log(log)
             if target == "message":
                 yield sha, metadata
             else:
-                # show the diffs for a given commit
-                cmd = ["git", "--git-dir", self.info["git_dir"],
-                       "show", sha, "--no-color", "--unified=0"]
-                (out, err) = execute_cmd(cmd)
-                file_diffs = self.parse_diff(diff=out, pattern=pattern)
+                pattern_set = PatternSet([pattern], self.info["regex_timeout"])
+                matches = iter_matches(self.iter_commit_diff(sha), pattern_set)
+                file_diffs = group_matches(matches).get(pattern)
                 if file_diffs:
                     metadata["files"] = file_diffs
                     yield sha, metadata
 
 
+    def search_history(self):
+        """
+        Searches the commit messages and diffs in each revision range
+        for every pattern at once, walking the history a single time
+        per range instead of once per pattern. Adds matches to results
+        in the same form as add_committed_results.
+
+        With a scan state, only walks the commits added to a range
+        since it was last scanned and reuses the stored results for
+        the rest.
+        """
+
+        for commit_range in self.info["revlist"]:
+            exclusions, previous = [], None
+            if self.state:
+                tips = self.get_tips(commit_range)
+                previous = self.state.get(commit_range)
+                if previous:
+                    exclusions = ["^" + tip for tip in self.get_existing(previous["tips"])]
+
+            if self.index:
+                history_results = self.search_history_indexed(commit_range, exclusions)
+            elif self.info["jobs"] > 1:
+                history_results = self.search_history_parallel(commit_range, exclusions)
+            else:
+                from tqdm import tqdm  # only loaded when the history is searched
+
+                history = tqdm(self.get_history(commit_range, exclusions), unit=" commits")
+                history_results = self.iter_history_results(history, self.pattern_set,
+                                                            self.blob_cache, self.limits)
+
+            found = ResultStore([])  # kept for the scan state
+            for pattern, sha, result in history_results:
+                self.add_result(pattern, sha, result)
+                if self.state:
+                    found.add(pattern, sha, result)
+
+            if self.state:
+                if previous:
+                    stored = self.filter_results(previous["results"], commit_range)
+                    for pattern, commits in stored.items():
+                        for sha, metadata in commits.items():
+                            self.add_result(pattern, sha, metadata)
+                            found.add(pattern, sha, metadata)
+                self.state.update(commit_range, tips, found.to_dict())
+
+        if self.state:
+            self.state.save()
+        if self.index:
+            self.index.close()
+
+
+    def search_history_indexed(self, commit_range, exclusions=()):
+        """
+        Adds the commits in a revision range that are not indexed yet
+        to the trigram index, then scans only those the index says
+        could match a pattern. Yields each pattern, commit, and result
+        found, in the same order as a scan of the whole range would.
+        """
+
+        from tqdm import tqdm
+
+        (out, err) = self.git.run(["rev-list", commit_range] + list(exclusions) +
+                                  self.get_log_filters())
+        shas = out.split()
+        missing = self.index.missing(shas)
+        if missing:
+            history = tqdm(self.get_commits(missing), total=len(missing), unit=" commits indexed")
+            self.index.add(missing, history)
+
+        candidates = self.index.candidates(shas, self.pattern_set)
+        if not candidates:
+            return iter([])
+        if self.info["jobs"] > 1:
+            return self.search_history_parallel(commit_range, exclusions, candidates)
+        history = tqdm(self.get_commits(candidates), total=len(candidates), unit=" commits")
+        return self.iter_history_results(history, self.pattern_set, self.blob_cache, self.limits)
+
+
+    def get_commits(self, shas):
+        """
+        Streams the logs and diffs of the commits shas (a non-empty
+        list), in the same order, like get_history.
+        """
+
+        args = self.get_history_args(["--no-walk=unsorted", "--stdin"])
+        return self.read_history(self.git.stream(args, stdin="\n".join(shas) + "\n", raw=True))
+
+
+    def search_history_parallel(self, commit_range, exclusions=(), shas=None):
+        """
+        Splits the commits in a revision range (or the commits shas
+        in it, if given) into shards and scans them on a pool of --jobs
+        processes. Yields each pattern, commit, and result found, in
+        the same order as a single process would find them.
+        """
+
+        if shas is None:
+            (out, err) = self.git.run(["rev-list", commit_range] + list(exclusions) +
+                                      self.get_log_filters())
+            shas = out.split()
+
+        jobs = self.info["jobs"]
+        shard_size = max(1, -(-len(shas) // (jobs * SHARDS_PER_JOB)))
+        shards = [(self.info["git_dir"], shas[i:i + shard_size])
+                  for i in range(0, len(shas), shard_size)]
+
+        import multiprocessing
+        from tqdm import tqdm
+
+        pool = multiprocessing.Pool(jobs, init_worker, (self.info,))
+        try:
+            for shard_results, skipped, shard_stats in tqdm(pool.imap(scan_shard, shards),
+                                                            total=len(shards), unit=" shards"):
+                self.limits.merge(skipped)
+                if shard_stats:
+                    stats.collector.merge(shard_stats)
+                for history_result in shard_results:
+                    yield history_result
+        finally:
+            pool.close()
+            pool.join()
+
+
+    @staticmethod
+    def iter_history_results(history, pattern_set, blob_cache, limits=None):
+        """
+        Takes the revisions yielded by get_history, a PatternSet, an
+        LRUCache of the matches in blob changes already scanned, and
+        optionally Limits cutting down the diffs. Yields
+        each pattern, commit, and result (the commit's metadata and its
+        matching message or files) found, one commit at a time. A blob
+        change carried by several commits (e.g. cherry-picks) is only
+        matched once.
+        """
+
+        for log, diff_lines in stats.timed_iter("parse_log", history):
+            sha, metadata = Poirot.parse_log(log)
+            message = metadata.pop("message", "")
+            messages = dict(pattern_set.search_message(message)) if message else {}
+            file_diffs = group_matches(iter_blob_matches(diff_lines, pattern_set, blob_cache, limits))
+            for pattern in pattern_set.keys:
+                result = {}
+                if pattern in messages:
+                    result["message"] = message
+                    result["message_span"] = list(messages[pattern].span())
+                if pattern in file_diffs:
+                    result["files"] = file_diffs[pattern]
+                if result:
+                    result.update(metadata)
+                    yield pattern, sha, result
+
+
+    def add_result(self, pattern, commit, metadata):
+        """
+        Adds a commit's (or the staged changes') matches for a pattern
+        to results or, with --output-format=ndjson, writes them out
+        straight away instead of keeping them.
+        """
+
+        if self.writer:
+            self.writer.write(pattern, commit, metadata)
+        else:
+            self.store.add(pattern, commit, metadata)
+
+
+    def filter_results(self, results, commit_range):
+        """
+        Returns the results for only the commits that are still in a
+        revision range (e.g. not rewritten by a force-push).
+        """
+
+        (out, err) = self.git.run(["rev-list", commit_range] + self.get_log_filters())
+        revisions = out.split()
+
+        lengths = set(len(sha) for commits in results.values() for sha in commits)
+        prefixes = set(sha[:length] for sha in revisions for length in lengths)
+        return {pattern: {sha: metadata for sha, metadata in commits.items() if sha in prefixes}
+                for pattern, commits in results.items()}
+
+
+    def get_existing(self, shas):
+        """
+        Returns the commits among shas that are still in the repository
+        (e.g. not garbage-collected after a force-push).
+        """
+
+        existing = []
+        for sha in shas:
+            found = self.git.read_object(sha)
+            if found and found[0] == "commit":
+                existing.append(sha)
+        return existing
+
+
+    def get_tips(self, commit_range):
+        """
+        Returns the SHAs of the commits a revision range includes the
+        ancestors of (e.g. the branch heads for --all).
+        """
+
+        (out, err) = self.git.run(["rev-parse", commit_range])
+        return [sha for sha in out.split() if not sha.startswith("^")]
+
+
+    def iter_commit_diff(self, sha):
+        """
+        Yields the added lines of a commit's diff, reading it through
+        the git backend only the first time a commit is requested while
+        it remains in the diff cache.
+        """
+
+        return self.iter_cached_diff(sha, lambda: self.git.diff(sha))
+
+
+    def iter_cached_diff(self, key, read_diff):
+        """
+        Yields the added lines of the diff stored in the diff cache
+        at key. Otherwise streams them from the diff lines returned by
+        read_diff, keeping a copy in the cache unless it outgrows the
+        cache, along with what the limits cut from it, which is
+        counted again each time the copy is used.
+        """
+
+        cached = self.diff_cache.get(key)
+        if cached is not None:
+            kept, skipped = cached
+            self.limits.merge(skipped)
+            for added in kept:
+                yield added
+            return
+
+        before = Counter(self.limits.skipped)
+        kept, size = [], 0
+        for added in iter_added_lines(read_diff(), self.limits):
+            if kept is not None:
+                kept.append(added)
+                size += sys.getsizeof(added) + sys.getsizeof(added[2])
+                if size > self.diff_cache.max_bytes:
+                    kept = None  # too big to cache, so stop copying it
+            yield added
+        if kept is not None:
+            self.diff_cache.put(key, (kept, self.limits.skipped - before), size)
+
+
+    def get_history(self, commit_range, exclusions=()):
+        """
+        Streams the logs and diffs of all revisions in a range from a
+        single git log. Yields each revision's log fields and an
+        iterator over its diff's lines (as bytes), which is read from
+        git as it is consumed and so must be consumed before the next
+        revision.
+        """
+
+        args = self.get_history_args([commit_range] + list(exclusions))
+        return self.read_history(self.git.stream(args + self.get_log_filters(), raw=True))
+
+
+    @staticmethod
+    def get_history_args(revisions):
+        """
+        Returns the arguments to git listing the logs and diffs of the
+        given revisions, as read by read_history.
+        """
+
+        # a NUL starts each log, and one ends each of its fields
+        return ["log"] + list(revisions) + [
+            "-p", "--no-color", "--unified=0", "--full-index",
+            "--format=%x00" + "".join(field + "%x00" for field in LOG_FIELDS)]
+
+
+    @staticmethod
+    def read_history(lines):
+        """
+        Takes the lines (as bytes) output by git given get_history_args.
+        Yields each revision's log fields and an iterator over its
+        diff's lines.
+        """
+
+        def read_revisions(lines):
+            """
+            Pairs each line of the log's output with the log of the
+            revision it belongs to, pairing the log with None as soon
+            as it is complete.
+            """
+
+            log, header, ended = None, None, 0
+            for line in lines:
+                if header is None and line.startswith(b"\x00"):  # a new revision's log begins
+                    log, header, ended, line = None, [], 0, line[1:]
+                if header is None:
+                    yield log, line
+                    continue
+                header.append(line)
+                ended += line.count(b"\x00")
+                if ended >= len(LOG_FIELDS):  # the log is complete; its diff follows
+                    log = tuple(b"".join(header).split(b"\x00")[:len(LOG_FIELDS)])
+                    header = None
+                    yield log, None
+
+        for log, lines in groupby(read_revisions(lines), key=lambda pair: pair[0]):
+            if log is not None:
+                yield log, (line for _, line in lines if line is not None)
+
+
+    def get_log_filters(self):
+        """
+        Returns the git log options restricting revisions by author
+        and date.
+        """
+
+        filters = []
+        if self.info["author"]:
+            filters.extend(["--author", self.info["author"]])
+        if self.info["before"]:
+            filters.extend(["--before", self.info["before"]])
+        if self.info["after"]:
+            filters.extend(["--after", self.info["after"]])
+        return filters
+
+
     def get_logs(self, target, pattern, commit_range):
         """
         Searches and returns git logs in a range of revisions that match a
         specified pattern, either in the message or modified lines.
         """
 
-        cmd = ["git", "--git-dir", self.info["git_dir"], "log",
-               commit_range, "-i", "-E", "--oneline"]
+        with stats.timed("get_logs"):
+            (out, err) = self.git.run(self.get_logs_args(target, pattern, commit_range), raw=True)
+        return self.split_logs(out)
+
+
+    def get_logs_args(self, target, pattern, commit_range):
+        """
+        Returns the arguments to git listing the logs get_logs returns.
+        """
+
+        cmd = ["log", commit_range, "-i", "-E", "--oneline", "-z"]  # -z ends each log with a NUL
 
         if target == "message":
-            cmd.extend(["--format=COMMIT: %h AUTHORDATE: %aD AUTHORNAME: %an AUTHOREMAIL: %ae LOG: %s %b"])
+            cmd.extend(["--format=" + "%x00".join(LOG_FIELDS)])
             cmd.extend(["--grep", pattern])  # limits matching to the log message
         elif target == "diff":
-            cmd.extend(["--format=COMMIT: %h AUTHORDATE: %aD AUTHORNAME: %an AUTHOREMAIL: %ae"])
+            cmd.extend(["--format=" + "%x00".join(LOG_FIELDS[:-1] + [""])])  # without the message
             cmd.extend(["-G" + pattern])  # matches on added/removed lines
 
-        if self.info["author"]:
-            cmd.extend(["--author", self.info["author"]])
-        if self.info["before"]:
-            cmd.extend(["--before", self.info["before"]])
-        if self.info["after"]:
-            cmd.extend(["--after", self.info["after"]])
+        cmd.extend(self.get_log_filters())
+        return cmd
+
+
+    @staticmethod
+    def split_logs(out):
+        """
+        Splits the output (as bytes) of get_logs_args into each log's
+        fields.
+        """
 
-        (out, err) = execute_cmd(cmd)
-        return out.strip().split("COMMIT: ")[1:]
+        fields, count = out.split(b"\x00"), len(LOG_FIELDS)
+        return [fields[i:i + count] for i in range(0, len(fields) - count + 1, count)]
 
 
     @staticmethod
     def parse_log(log):
         """
-        Parses the information contained in a pretty-formatted
-        --oneline commit log (i.e. the commit SHA, author's
-        name and email, the date the commit was authored, and,
-        optionally, the commit's message).
+        Parses the fields of a commit's log, as split by split_logs or
+        read_history (i.e. the commit SHA, author's name and email,
+        the date the commit was authored, and, optionally, the
+        commit's message), decoding each on its own.
         """
 
-        metadata = {}
-        sha, log = log.split(" AUTHORDATE: ", 1)
-        metadata["author_date"], log = log.split(" AUTHORNAME: ", 1)
-        metadata["author_name"], log = log.split(" AUTHOREMAIL: ", 1)
-        try:
-            metadata["author_email"], metadata["message"] = log.split(" LOG: ", 1)
-            metadata["message"] = utf8_decode(metadata["message"])
-        except ValueError:
-            metadata["author_email"] = log
-        metadata = {key: metadata[key].strip() for key in metadata.keys()}
+        sha, author_date, author_name, author_email, message = [to_text(field).strip()
+                                                                for field in log]
+        metadata = {"author_date": author_date, "author_name": author_name,
+                    "author_email": author_email}
+        if message:
+            metadata["message"] = message
         return sha, metadata
 
 
@@ -167,43 +694,16 @@ class Poirot(object):
         and lines in the revision that match the pattern.
         """
 
-        def split_diff(diff):
-            """
-            Divides a diff into the file name and the rest of its
-            (split by newline).
-            """
-
-            deleted_re = regex.compile(r"^deleted file")
-
-            try:
-                diff = diff.split("\n", 2)
-                if not deleted_re.match(diff[1]):
-                    filename = diff[0].split(" b/", 1)[1]
-                    diff = "@@" + diff[2].split("@@", 1)[1]
-                    diff_text = diff.split("\n")
-                    return filename, diff_text
-            except IndexError:
-                pass
+        return Poirot.parse_diff_patterns(diff, [pattern]).get(pattern, [])
 
-        def find_matches_in_diff(diff_text):
-            """
-            Takes the lines from a file's diff and yields them
-            if they were added and match the given pattern.
-            """
 
-            line_re = regex.compile(r"@@ \-[0-9,]+ \+([0-9]+)[, ].*")
-            pattern_re = regex.compile(pattern, regex.I)
-            line_num = 0
-            for line in diff_text:
-                line = utf8_decode(line)
-                if not line:
-                    pass
-                elif line[0] == "@":
-                    line_num = int(regex.sub(line_re, r"\1", line))
-                elif line[0] == "+":
-                    if pattern_re.search(line):
-                        yield {"line": line_num, "text": line[1:].strip()}
-                    line_num += 1
+    @staticmethod
+    def parse_diff_patterns(diff, patterns):
+        """
+        Takes a single commit's diff and a list of patterns. Returns
+        a dict of each matching pattern to the files and lines in the
+        revision that match it, reading the diff only once.
+        """
 
         try:
             if isinstance(diff, bytes):
@@ -211,32 +711,59 @@ class Poirot(object):
         except:
             pass
 
-        files = []
-        file_diffs = diff.split("diff --git ")[1:]  # split the diff by file modified
-
-        for file_diff in file_diffs:
-            try:
-                (filename, diff_text) = split_diff(file_diff)
-                matches = [m for m in find_matches_in_diff(diff_text)]
-                if matches:
-                    files.append({"file": filename, "matches": matches})
-            except TypeError:  # ignore empty lines
-                pass
-        return files
+        added_lines = iter_added_lines(diff.split("\n"))
+        return group_matches(iter_matches(added_lines, PatternSet(patterns)))
 
 
     def get_results(self):
+        """
+        Writes out the results and, when rendering them, prints them and
+        exits. Otherwise returns them as a dict of each pattern to a
+        dict of the commits matching it to their metadata.
+        """
 
-        if self.info["output"]:
-            with open(self.info["output"], "w") as outfile:
-                json.dump(self.results, outfile, ensure_ascii=False, indent=4)
-
+        self.write_results()
         if not self.render_results:
-            return self.results
+            return self.store.to_dict()
+
+        if self.writer:
+            if self.writer.count:
+                out = "Poirot wrote {} matches to {}".format(
+                    self.writer.count, self.info["output"] or "standard output")
+                print(style(out, "red"), file=sys.stderr)
+                sys.exit(1)
+            print(style("Poirot didn't find anything!", "darkblue"), file=sys.stderr)
+            sys.exit(0)
 
         if any(self.results.values()):
+            from .clients import render  # loads jinja2, so only when there's something to render
+
             render(self.results, self.info)
             sys.exit(1)
         else:
             print(style("Poirot didn't find anything!", "darkblue"))
             sys.exit(0)
+
+
+    def write_results(self):
+        """
+        Prints the stats and what the limits skipped, and writes the
+        results to --output, if given, reading them from the store one
+        commit at a time.
+        """
+
+        report = stats.collector.to_dict() if stats.collector else None
+        if report:
+            stats.print_stats(report)
+        skipped = self.limits.summary()
+        if skipped:
+            print(style(skipped, "darkblue"), file=sys.stderr)
+
+        if self.writer:
+            if report:
+                self.writer.write_record({stats.STATS_KEY: report})
+            self.writer.close()
+        elif self.info["output"]:
+            extra = {stats.STATS_KEY: report} if report else None
+            with open(self.info["output"], "w") as outfile:
+                write_json(self.results, outfile, extra)
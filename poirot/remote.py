@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import hashlib
+import threading
+
+from .filters import style
+
+# seconds a cached remote pattern file is used without checking it for changes
+CACHE_TTL = 60 * 60
+# seconds to wait on a server for a remote pattern file
+FETCH_TIMEOUT = 10
+
+
+def get_cache_dir():
+    """
+    Returns the directory remote pattern files are cached in:
+    poirot in $XDG_CACHE_HOME, or in ~/.cache.
+    """
+
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "poirot")
+
+
+class PatternFileCache(object):
+    """
+    Fetches remote pattern files, keeping a copy of each on disk. A
+    copy younger than ttl seconds (CACHE_TTL by default) is used as is; an older one is
+    revalidated with its ETag and Last-Modified date, and only
+    downloaded again if it changed. Offline, the copies are used no
+    matter their age.
+    """
+
+    def __init__(self, cache_dir=None, ttl=None, offline=False):
+        self.cache_dir = cache_dir or get_cache_dir()
+        self.ttl = CACHE_TTL if ttl is None else ttl
+        self.offline = offline
+
+    def fetch_all(self, urls):
+        """
+        Fetches the pattern files at urls concurrently. Returns a dict
+        of each URL to its text, or to None if it could not be had.
+        """
+
+        fetched = {}
+
+        def fetch(url):
+            fetched[url] = self.fetch(url)
+
+        threads = [threading.Thread(target=fetch, args=(url,)) for url in set(urls)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return fetched
+
+    def fetch(self, url):
+        """
+        Returns the text of the pattern file at url, from the cache if
+        it can be, or None if it could not be had (printing why).
+        """
+
+        path = os.path.join(self.cache_dir, hashlib.sha1(url.encode("utf-8")).hexdigest())
+        meta = self.read_meta(path)
+        if meta and (self.offline or time.time() - meta["fetched"] < self.ttl):
+            return self.read_text(path)
+        if self.offline:
+            print(style("Pattern file {} isn't cached, so can't be read offline".format(url), "red"),
+                  file=sys.stderr)
+            return None
+
+        import requests  # only loaded for remote pattern files
+
+        headers = {}
+        if meta and meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta and meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+        try:
+            response = requests.get(url, headers=headers, timeout=FETCH_TIMEOUT)
+        except requests.RequestException as error:
+            return self.fall_back(path, meta, url, error)
+
+        if response.status_code == 304 and meta:
+            meta["fetched"] = time.time()
+            self.write(path, meta)
+            return self.read_text(path)
+        elif response.status_code != 200:
+            return self.fall_back(path, meta, url, "HTTP {}".format(response.status_code))
+
+        meta = {"url": url, "fetched": time.time(), "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified")}
+        self.write(path, meta, response.text)
+        return response.text
+
+    def fall_back(self, path, meta, url, error):
+        """
+        Returns the cached copy of a pattern file that could not be
+        fetched, if there is one, printing the error either way.
+        """
+
+        if meta:
+            out = "Couldn't fetch pattern file {} ({}); using the copy cached {}".format(
+                url, error, time.strftime("%Y-%m-%d %H:%M", time.localtime(meta["fetched"])))
+            print(style(out, "red"), file=sys.stderr)
+            return self.read_text(path)
+        print(style("Couldn't fetch pattern file {} ({})".format(url, error), "red"), file=sys.stderr)
+        return None
+
+    def read_meta(self, path):
+        """
+        Returns the metadata of a pattern file's cached copy, or None
+        if there is no copy.
+        """
+
+        if not os.path.exists(path + ".txt"):
+            return None
+        try:
+            with open(path + ".json") as infile:
+                return json.load(infile)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def read_text(self, path):
+        with open(path + ".txt", "rb") as infile:
+            return infile.read().decode("utf-8")
+
+    def write(self, path, meta, text=None):
+        """
+        Writes a pattern file's cached copy, if given, then its
+        metadata, each replacing the previous one only once it has
+        been completely written. Failing to write them only means the
+        file is fetched again next time.
+        """
+
+        files = [(".json", json.dumps(meta).encode("utf-8"))]
+        if text is not None:
+            files.insert(0, (".txt", text.encode("utf-8")))
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            for extension, data in files:
+                temp_path = "{}{}.{}.tmp".format(path, extension, threading.current_thread().ident)
+                with open(temp_path, "wb") as outfile:
+                    outfile.write(data)
+                os.rename(temp_path, path + extension)
+        except (IOError, OSError) as error:
+            print(style("Couldn't cache pattern file {}: {}".format(meta["url"], error), "red"),
+                  file=sys.stderr)
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+from collections import OrderedDict
+try:
+    from collections.abc import Mapping
+except ImportError:  # Python 2
+    from collections import Mapping
+
+from .output import AUTHOR_FIELDS
+
+
+class Match(object):
+    """
+    A line matching a pattern: its number, text, and the span of the
+    match within the text (or None).
+    """
+
+    __slots__ = ("line", "text", "span")
+
+    def __init__(self, line, text, span=None):
+        self.line = line
+        self.text = text
+        self.span = tuple(span) if span is not None else None
+
+    def to_dict(self):
+        match = {"line": self.line, "text": self.text}
+        if self.span is not None:
+            match["span"] = list(self.span)
+        return match
+
+
+class Hit(object):
+    """
+    What of a commit matches one pattern: whether its message does
+    (and where), and the lines of each file that do, as a list of
+    (file name, matches) pairs, or None.
+    """
+
+    __slots__ = ("message", "message_span", "files")
+
+    def __init__(self):
+        self.message = False
+        self.message_span = None
+        self.files = None
+
+
+class Commit(object):
+    """
+    A commit (or the staged changes, or a tree) with matches: its
+    authorship and message, kept once however many patterns it
+    matches, and its Hit for each of them.
+    """
+
+    __slots__ = AUTHOR_FIELDS + ("message", "hits")
+
+    def __init__(self):
+        for field in AUTHOR_FIELDS:
+            setattr(self, field, None)
+        self.message = None
+        self.hits = {}
+
+
+class ResultStore(object):
+    """
+    Keeps the results of a search indexed by commit rather than by
+    pattern, so that a commit matching many patterns is only stored
+    once. File names and authorship are shared between the commits
+    and matches they appear in. Its view gives results in their usual
+    form, a mapping of each pattern to the commits matching it and
+    their metadata, building the metadata one commit at a time.
+    """
+
+    def __init__(self, patterns):
+        self.order = OrderedDict((pattern, []) for pattern in patterns)  # pattern -> commits
+        self.commits = {}
+        self.strings = {}
+
+    def share(self, text):
+        """
+        Returns the copy of text already kept by the store, keeping
+        text if there is none.
+        """
+
+        return self.strings.setdefault(text, text) if text is not None else None
+
+    def add(self, pattern, commit, metadata):
+        """
+        Adds a commit's metadata for a pattern, in the form of results,
+        updating what was added for them before like dict.update would.
+        """
+
+        record = self.commits.get(commit)
+        if record is None:
+            commit = self.share(commit)
+            record = self.commits[commit] = Commit()
+        hit = record.hits.get(pattern)
+        if hit is None:
+            hit = record.hits[pattern] = Hit()
+            self.order.setdefault(pattern, []).append(commit)
+
+        for field in AUTHOR_FIELDS:
+            if field in metadata:
+                setattr(record, field, self.share(metadata[field]))
+        if "message" in metadata:
+            record.message = metadata["message"]
+            hit.message = True
+        if "message_span" in metadata:
+            hit.message_span = tuple(metadata["message_span"])
+        if "files" in metadata:
+            hit.files = [(self.share(file_diff["file"]),
+                          [Match(match["line"], match["text"], match.get("span"))
+                           for match in file_diff["matches"]])
+                         for file_diff in metadata["files"]]
+
+    def get(self, pattern, commit):
+        """
+        Returns a commit's metadata for a pattern, in the form of
+        results.
+        """
+
+        record = self.commits[commit]
+        hit = record.hits[pattern]
+        metadata = {}
+        if hit.message:
+            metadata["message"] = record.message
+        if hit.message_span is not None:
+            metadata["message_span"] = list(hit.message_span)
+        if hit.files is not None:
+            metadata["files"] = [{"file": name, "matches": [match.to_dict() for match in matches]}
+                                 for name, matches in hit.files]
+        for field in AUTHOR_FIELDS:
+            if getattr(record, field) is not None:
+                metadata[field] = getattr(record, field)
+        return metadata
+
+    def view(self):
+        """
+        Returns a Results view of the store.
+        """
+
+        return Results(self)
+
+    def to_dict(self):
+        """
+        Returns the results: a dict of each pattern to a dict of the
+        commits matching it to their metadata.
+        """
+
+        return {pattern: {commit: self.get(pattern, commit) for commit in commits}
+                for pattern, commits in self.order.items()}
+
+
+class Results(Mapping):
+    """
+    A read-only view of a ResultStore in the form of results: a mapping
+    of each pattern to the mapping of the commits matching it to their
+    metadata. A commit's metadata is only built when it is read, so the
+    results are never copied whole.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def __getitem__(self, pattern):
+        if pattern not in self.store.order:
+            raise KeyError(pattern)
+        return PatternResults(self.store, pattern)
+
+    def __iter__(self):
+        return iter(self.store.order)
+
+    def __len__(self):
+        return len(self.store.order)
+
+
+class PatternResults(Mapping):
+    """
+    A read-only view of the commits in a ResultStore matching a pattern,
+    mapping each to its metadata, built when it is read.
+    """
+
+    def __init__(self, store, pattern):
+        self.store = store
+        self.pattern = pattern
+
+    def __getitem__(self, commit):
+        record = self.store.commits.get(commit)
+        if record is None or self.pattern not in record.hits:
+            raise KeyError(commit)
+        return self.store.get(self.pattern, commit)
+
+    def __iter__(self):
+        return iter(self.store.order[self.pattern])
+
+    def __len__(self):
+        return len(self.store.order[self.pattern])
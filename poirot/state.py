@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import os
+import json
+import hashlib
+
+from .filters import style
+
+STATE_VERSION = 1
+
+
+def scan_key(info):
+    """
+    Returns a hash identifying the patterns and revision filters
+    of a scan, whose results can only be reused by a scan with the
+    same ones.
+    """
+
+    scope = {
+        "patterns": sorted(info["patterns"]),
+        "author": info["author"],
+        "before": info["before"],
+        "after": info["after"]
+    }
+    for limit in ("max_diff_size", "max_line_length", "exclude"):
+        if info.get(limit):  # only when set, so that earlier scans are still reused
+            scope[limit] = info[limit]
+    return hashlib.sha1(json.dumps(scope, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class ScanState(object):
+    """
+    Keeps track, in a JSON file, of the commits already scanned in each
+    revision range (by the tips of the range when it was scanned) and
+    the results found in them, per pattern set.
+    """
+
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+        self.data = {"version": STATE_VERSION, "scans": {}}
+        try:
+            with open(path) as infile:
+                data = json.load(infile)
+            if data.get("version") == STATE_VERSION:
+                self.data = data
+        except (IOError, OSError):
+            pass
+        except ValueError:
+            print(style("Ignoring unreadable scan state file: {}".format(path), "red"))
+        self.scans = self.data["scans"].setdefault(key, {})
+
+    def get(self, commit_range):
+        """
+        Returns the tips and results recorded for a revision range,
+        or None if it has not been scanned with this pattern set.
+        """
+
+        return self.scans.get(commit_range)
+
+    def update(self, commit_range, tips, results):
+        """
+        Records the tips a revision range has been scanned up to and
+        all results found in it.
+        """
+
+        self.scans[commit_range] = {"tips": tips, "results": results}
+
+    def save(self):
+        """
+        Writes the state file, replacing the previous one only once
+        the new one has been completely written.
+        """
+
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as outfile:
+            json.dump(self.data, outfile, ensure_ascii=False)
+        os.rename(temp_path, self.path)
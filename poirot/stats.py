@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import sys
+import time
+import threading
+from contextlib import contextmanager
+
+from .filters import style
+
+# the key the stats are stored under in the --output JSON
+STATS_KEY = "_poirot_stats"
+# the Stats being collected by this process when --stats is given
+collector = None
+clock = getattr(time, "perf_counter", time.time)
+
+
+class Stats(object):
+    """
+    Tallies where a search spends its time: the git processes it runs
+    and the bytes read from them, the calls to and time spent in each
+    instrumented step, and the lines scanned and time spent matching
+    each pattern. A step's time leaves out that of the steps and
+    patterns timed within it, so that the times add up.
+    """
+
+    def __init__(self):
+        self.started = clock()
+        self.subprocesses = 0
+        self.bytes_read = 0
+        self.lines_scanned = 0
+        self.messages_scanned = 0
+        self.steps = {}  # step name -> [calls, seconds]
+        self.patterns = {}  # pattern -> [searches, matches, seconds]
+        self.local = threading.local()  # each thread's stack of the time nested in its running steps
+
+    def add_step(self, name, seconds):
+        step = self.steps.setdefault(name, [0, 0.0])
+        step[0] += 1
+        step[1] += seconds
+        self.spend(seconds)
+
+    def add_pattern(self, pattern, seconds, matched):
+        tally = self.patterns.setdefault(pattern, [0, 0, 0.0])
+        tally[0] += 1
+        tally[1] += int(matched)
+        tally[2] += seconds
+        self.spend(seconds)
+
+    def running(self):
+        """
+        Returns the current thread's stack of the time spent within
+        each step it is timing.
+        """
+
+        if not hasattr(self.local, "running"):
+            self.local.running = []
+        return self.local.running
+
+    def spend(self, seconds):
+        """
+        Counts seconds as spent within the innermost step being timed,
+        if any, to be left out of that step's own time.
+        """
+
+        running = self.running()
+        if running:
+            running[-1] += seconds
+
+    def to_dict(self):
+        """
+        Returns the stats as a JSON-serializable dict.
+        """
+
+        return {
+            "wall_seconds": clock() - self.started,
+            "subprocesses": self.subprocesses,
+            "bytes_read": self.bytes_read,
+            "lines_scanned": self.lines_scanned,
+            "messages_scanned": self.messages_scanned,
+            "steps": {name: {"calls": calls, "seconds": seconds}
+                      for name, (calls, seconds) in self.steps.items()},
+            "patterns": {pattern: {"searches": searches, "matches": matches, "seconds": seconds}
+                         for pattern, (searches, matches, seconds) in self.patterns.items()}
+        }
+
+    def merge(self, other):
+        """
+        Adds the counts and times of the stats dict other (e.g. sent
+        back by a --jobs worker process), except for its wall time.
+        """
+
+        self.subprocesses += other["subprocesses"]
+        self.bytes_read += other["bytes_read"]
+        self.lines_scanned += other["lines_scanned"]
+        self.messages_scanned += other["messages_scanned"]
+        for name, step in other["steps"].items():
+            tally = self.steps.setdefault(name, [0, 0.0])
+            tally[0] += step["calls"]
+            tally[1] += step["seconds"]
+        for pattern, cost in other["patterns"].items():
+            tally = self.patterns.setdefault(pattern, [0, 0, 0.0])
+            tally[0] += cost["searches"]
+            tally[1] += cost["matches"]
+            tally[2] += cost["seconds"]
+
+
+def enable(on=True):
+    """
+    Starts collecting stats in this process (or stops, if on is
+    false), discarding any collected so far. Returns the collector.
+    """
+
+    global collector
+    collector = Stats() if on else None
+    return collector
+
+
+def drain():
+    """
+    Returns the stats collected so far as a dict, or None if they
+    are not being collected, and starts collecting afresh.
+    """
+
+    if collector is None:
+        return None
+    collected = collector.to_dict()
+    enable()
+    return collected
+
+
+@contextmanager
+def timed(name):
+    """
+    Adds the time spent in the with block to the step called name,
+    when stats are being collected.
+    """
+
+    if collector is None:
+        yield
+        return
+    stats, running = collector, collector.running()
+    running.append(0.0)
+    start = clock()
+    try:
+        yield
+    finally:
+        elapsed = clock() - start
+        nested = running.pop()
+        stats.add_step(name, elapsed - nested)
+        stats.spend(nested)
+
+
+def timed_iter(name, iterable):
+    """
+    Returns iterable or, when stats are being collected, an iterator
+    over it adding the time spent producing each item to the step
+    called name.
+    """
+
+    if collector is None:
+        return iterable
+    return iter_timed(name, iter(iterable))
+
+
+def iter_timed(name, iterator):
+    while True:
+        with timed(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def add_subprocess():
+    if collector is not None:
+        collector.subprocesses += 1
+
+
+def add_bytes_read(size):
+    if collector is not None:
+        collector.bytes_read += size
+
+
+def print_stats(report, outfile=sys.stderr):
+    """
+    Prints the stats dict report as a table, with the patterns that
+    took the longest to match first.
+    """
+
+    print(style("Poirot's stats", "bold"), file=outfile)
+    print("  {:.3f}s wall time, {} git processes, {} bytes read, {} lines and {} messages scanned".format(
+        report["wall_seconds"], report["subprocesses"], report["bytes_read"],
+        report["lines_scanned"], report["messages_scanned"]), file=outfile)
+
+    if report["steps"]:
+        print("  {:>10} {:>8}  step".format("seconds", "calls"), file=outfile)
+        for name, step in sorted(report["steps"].items(), key=lambda item: -item[1]["seconds"]):
+            print("  {:10.3f} {:8d}  {}".format(step["seconds"], step["calls"], name), file=outfile)
+
+    if report["patterns"]:
+        print("  {:>10} {:>8} {:>8}  pattern".format("seconds", "searches", "matches"), file=outfile)
+        for pattern, cost in sorted(report["patterns"].items(), key=lambda item: -item[1]["seconds"]):
+            print("  {:10.3f} {:8d} {:8d}  {}".format(cost["seconds"], cost["searches"],
+                                                      cost["matches"], pattern), file=outfile)
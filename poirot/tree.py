@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import os
+import sys
+import mmap
+
+from . import stats
+from .diffs import iter_matches
+from .filters import style
+from .gitio import SKIP_BYTES
+from .utils import execute_cmd, to_text
+
+# how far into a file to look for a NUL byte to tell that it is binary,
+# as git does
+BINARY_CHECK_BYTES = 8000
+# git's file mode for symbolic links, whose targets are not scanned
+SYMLINK_MODE = "120000"
+# the most bytes a character takes up in UTF-8
+MAX_CHAR_BYTES = 4
+
+
+def is_binary(data):
+    """
+    Returns whether the bytes (or memory-mapped file) data look
+    binary, i.e. have a NUL byte near the start.
+    """
+
+    return data.find(b"\x00", 0, BINARY_CHECK_BYTES) != -1
+
+
+def list_files(git, repo_dir, rev):
+    """
+    Returns the files to scan, as (path, blob SHA) pairs: those in the
+    tree of the revision rev or, if rev is empty, those in the working
+    tree (tracked, or untracked but not ignored) with no blob SHA.
+    """
+
+    if not rev:
+        (out, err) = execute_cmd(["git", "-C", repo_dir, "ls-files", "-z",
+                                  "--cached", "--others", "--exclude-standard"], raw=True)
+        return [(to_text(path), None) for path in sorted(set(out.split(b"\x00"))) if path]
+
+    (out, err) = git.run(["ls-tree", "-r", "-z", rev], raw=True)
+    if err:
+        print(style("Couldn't list the files at {}: {}".format(rev, to_text(err).strip()), "red"),
+              file=sys.stderr)
+    files = []
+    for entry in out.split(b"\x00"):
+        if not entry:
+            continue
+        info, path = entry.split(b"\t", 1)
+        mode, kind, sha = to_text(info).split()
+        if kind == "blob" and mode != SYMLINK_MODE:
+            files.append((to_text(path), sha))
+    return files
+
+
+def decode_cut(data):
+    """
+    Decodes a line cut short, as to_text would, leaving out a
+    character cut in two at its end.
+    """
+
+    for end in range(len(data), max(len(data) - MAX_CHAR_BYTES, 0), -1):
+        try:
+            return data[:end].decode("utf-8")
+        except UnicodeDecodeError:
+            pass
+    return to_text(data)
+
+
+def iter_lines(readline, max_line_length=None):
+    """
+    Yields the line number and text of each line read with readline
+    (which, like a file's, takes the most bytes to read). With a
+    max_line_length, reads only as much of a longer line as it takes
+    to tell that Limits will cut it short, and skips the rest.
+    """
+
+    if max_line_length is None:
+        for line_num, line in enumerate(iter(readline, b""), 1):
+            yield line_num, to_text(line).rstrip("\r\n")
+        return
+
+    # enough for two more characters than are kept, even with one cut in two
+    size = (max_line_length + 2) * MAX_CHAR_BYTES
+    for line_num, line in enumerate(iter(lambda: readline(size), b""), 1):
+        if len(line) < size or line.endswith(b"\n"):
+            yield line_num, to_text(line).rstrip("\r\n")
+            continue
+        rest = line
+        while rest and not rest.endswith(b"\n"):
+            rest = readline(SKIP_BYTES)
+        yield line_num, decode_cut(line)
+
+
+def mmap_readline(mapped):
+    """
+    Returns a readline function for a memory-mapped file that, unlike
+    its own, takes the most bytes to read.
+    """
+
+    def readline(size=-1):
+        start = mapped.tell()
+        end = mapped.find(b"\n", start)
+        end = len(mapped) if end == -1 else end + 1
+        if size >= 0:
+            end = min(end, start + size)
+        mapped.seek(end)
+        return mapped[start:end]
+
+    return readline
+
+
+def iter_file_lines(path, limits=None):
+    """
+    Yields the line number and text of each line of a file on disk,
+    reading it through a memory map so that it is never copied into
+    memory whole, and cutting lines as Limits, if given, would.
+    Yields nothing for a binary (counted by limits), empty, or
+    unreadable file, or a symbolic link.
+    """
+
+    if os.path.islink(path) or not os.path.isfile(path):
+        return
+    try:
+        with open(path, "rb") as infile:
+            if os.fstat(infile.fileno()).st_size == 0:
+                return
+            mapped = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError):
+        return
+
+    try:
+        if is_binary(mapped):
+            if limits:
+                limits.skipped["binary"] += 1
+            return
+        max_line_length = limits and limits.max_line_length
+        readline = mmap_readline(mapped) if max_line_length is not None else mapped.readline
+        for line in iter_lines(readline, max_line_length):
+            yield line
+    finally:
+        mapped.close()
+
+
+def iter_blob_lines(reader, limits=None):
+    """
+    Yields the line number and text of each line of a blob's contents,
+    streamed through git cat-file by an ObjectReader, and cutting
+    lines as Limits, if given, would. Yields nothing for a binary blob
+    (counted by limits), or if reader is None.
+    """
+
+    if reader is None:
+        return
+    if is_binary(reader.peek(BINARY_CHECK_BYTES)):
+        if limits:
+            limits.skipped["binary"] += 1
+        return
+    for line in iter_lines(reader.readline, limits and limits.max_line_length):
+        yield line
+
+
+def iter_tree_matches(files, repo_dir, git, pattern_set, limits=None):
+    """
+    Takes files, as returned by list_files, the repository's directory,
+    a GitBackend, a PatternSet, and optionally Limits. Yields each
+    pattern, file name, and line that match, like iter_matches, reading
+    files with a blob SHA through git and the rest from disk. Stops
+    reading a file as soon as limits cut it short.
+    """
+
+    for path, sha in files:
+        if limits and limits.excludes(path):
+            continue
+        reader = None
+        if sha:
+            found = git.open_object(sha)
+            reader = found[2] if found else None
+            lines = iter_blob_lines(reader, limits)
+        else:
+            lines = iter_file_lines(os.path.join(repo_dir, path), limits)
+        lines = stats.timed_iter("read_git" if sha else "read_file", lines)
+        # each line is passed to iter_matches as though it were added
+        added_lines = ((path, line_num, "+" + line) for line_num, line in lines)
+        if limits:
+            added_lines = limits.cut_file(added_lines)
+        try:
+            for match in iter_matches(added_lines, pattern_set):
+                yield match
+        finally:
+            if reader:
+                reader.close()  # skips past what is left of the blob
@@ -5,7 +5,9 @@ from __future__ import print_function
 import os
 import sys
 import subprocess
+from collections import OrderedDict
 
+from . import stats
 from .filters import style
 
 
@@ -48,26 +50,105 @@ def merge_dicts(*dicts):
     return merged
 
 
-def execute_cmd(cmd):
+class LRUCache(object):
     """
-    Executes a command and returns the stdout and stderr.
+    A mapping that holds values up to a total size in bytes,
+    evicting the least recently used values to stay within it.
     """
 
-    try:
-        popen = subprocess.Popen(cmd, stderr=subprocess.PIPE, stdout=subprocess.PIPE,
-                                 universal_newlines=True)
-        (out, err) = popen.communicate()
-    except UnicodeDecodeError:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        """
+        Returns the value cached at key, marking it as most recently
+        used, or default if it is not cached.
+        """
+
+        try:
+            value, size = self.entries.pop(key)
+        except KeyError:
+            return default
+        self.entries[key] = (value, size)
+        return value
+
+    def put(self, key, value, size):
+        """
+        Caches a value of the given size at key. Values larger than
+        the whole budget are not cached.
+        """
+
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[1]
+        if size > self.max_bytes:
+            return
+        self.entries[key] = (value, size)
+        self.size += size
+        while self.size > self.max_bytes:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+
+
+def execute_cmd(cmd, raw=False):
+    """
+    Executes a command and returns the stdout and stderr, decoded
+    as by to_text, or as bytes if raw.
+    """
+
+    with stats.timed("execute_cmd"):
         popen = subprocess.Popen(cmd, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
         (out, err) = popen.communicate()
+    stats.add_subprocess()
+    stats.add_bytes_read(len(out))
+    if raw:
+        return (out, err)
+    return (to_text(out), to_text(err))
+
+
+def stream_cmd(cmd, stdin=None, raw=False):
+    """
+    Executes a command and yields its stdout line by line as it is
+    produced, rather than waiting for the command to finish, decoded
+    as by to_text, or as bytes if raw. Optionally writes the text
+    stdin to its standard input first.
+    """
+
+    with open(os.devnull, "w") as devnull:
+        popen = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=devnull,
+                                 stdin=subprocess.PIPE if stdin is not None else None)
         try:
-            out = out.decode("latin-1")
-            out = out.encode("utf-8")
-        except:
-            error = sys.exc_info()[0]
-            print(style("There was a problem executing command: {}\n".format(cmd), "red"), error)
-            out = ""
-    return (out, err)
+            if stdin is not None:
+                popen.stdin.write(stdin.encode("utf-8"))
+                popen.stdin.close()
+            stats.add_subprocess()
+            for line in stats.timed_iter("read_git", iter(popen.stdout.readline, b"")):
+                stats.add_bytes_read(len(line))
+                yield line if raw else to_text(line)
+        finally:
+            popen.stdout.close()
+            popen.wait()
+
+
+def to_text(text):
+    """
+    Decodes bytes as UTF-8, falling back to Latin-1 for anything
+    that is not valid UTF-8.
+    """
+
+    try:
+        return text.decode("utf-8")
+    except UnicodeDecodeError:
+        return text.decode("latin-1")
+    except AttributeError:
+        return text
 
 
 def utf8_decode(text):
@@ -84,20 +165,22 @@ def is_git_dir(directory):
                       the correct local directory with
                       --dir""".format(directory=directory))
 
-def clone_pull(git_url, repo_dir):
+def clone_pull(git_url, repo_dir, pull=None):
     """
     Clones a repository from `git_url` or optionally does a
     git pull if the repository already exists at `repo_dir`.
     Runs only if url argument provided to poirot command.
+    Asks whether to pull, unless `pull` is True or False.
     """
     try:
         cmd = ["git", "clone", git_url, repo_dir]
         subprocess.check_output(cmd, universal_newlines=True)
 
     except subprocess.CalledProcessError:
-        response = ask("Do you want to git-pull?", ["y", "n"], "darkblue")
-        if response == "y":
-            cmd = ["git", "--git-dir=%s/.git" % (repo_dir), "pull"]
+        if pull is None:
+            pull = ask("Do you want to git-pull?", ["y", "n"], "darkblue") == "y"
+        if pull:
+            cmd = ["git", "-C", repo_dir, "pull"]
             out = subprocess.check_output(cmd, universal_newlines=True)
             print(style("Git says: {}".format(out), "smoke"))
 
@@ -22,6 +22,9 @@ setup(name='poirot',
           'regex>=2015.11.22',
           'requests>=2.9.1'
           ],
+      extras_require={
+          'entropy': ['numpy>=1.9'],
+          },
       test_suite='nose.collector',
       tests_require=['nose-progressive'],
       classifiers=[
@@ -39,6 +42,9 @@ setup(name='poirot',
       entry_points={
           'console_scripts': [
               'poirot=poirot.poirot:main',
+              'poirot-batch=poirot.batch:main',
+              'poirot-daemon=poirot.daemon:daemon_main',
+              'poirot-client=poirot.daemon:client_main',
               ]
       },
       zip_safe=False)
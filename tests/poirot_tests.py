@@ -1,19 +1,45 @@
 # -*- coding: utf-8 -*-
 
+import io
 import os
 import json
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 
+from nose.plugins.skip import SkipTest
 from nose.tools import *
 
+try:
+    from http.server import HTTPServer, SimpleHTTPRequestHandler
+except ImportError:  # Python 2
+    from BaseHTTPServer import HTTPServer
+    from SimpleHTTPServer import SimpleHTTPRequestHandler
+
 from poirot.poirot import Poirot, main
-from poirot.filters import style, STYLE_CODES, wrap
-from poirot.utils import ask, execute_cmd, merge_dicts
-from poirot.parser import parse_arguments
+from poirot import batch, daemon, entropy
+from poirot.diffs import Limits, iter_added_lines, iter_matches
+from poirot.gitio import GitBackend
+from poirot.index import TrigramIndex
+from poirot.entropy import EntropyDetector, score_tokens, score_tokens_numpy, score_tokens_python
+from poirot.matcher import ENTROPY_PATTERN, PatternSet, required_literal
+from poirot.filters import highlight, style, STYLE_CODES, wrap
+from poirot.utils import LRUCache, ask, execute_cmd, merge_dicts
+from poirot.parser import parse_arguments, parse_patterns
+from poirot.remote import PatternFileCache
+from poirot.tree import iter_lines
+from poirot.output import write_json
+from poirot.results import ResultStore
 
 
 current_dir = os.path.dirname(os.path.realpath(__file__))
 test_repo = "https://github.com/emanuelfeld/poirot-test-repo.git"
 test_dir = "{}/fixtures".format(current_dir)
+# seconds a fresh interpreter may take to import Poirot's command line
+IMPORT_BUDGET = 0.25
 args = [
     "--url={url}".format(url=test_repo),
     "--revlist=all",
@@ -25,6 +51,37 @@ args = [
 info = parse_arguments(args)
 
 
+def make_repo(commits):
+    """
+    Builds a local git repository from a list of (message, files)
+    commits, where files maps paths to their new contents (or None
+    to delete them). Returns the repository's directory.
+    """
+
+    repo_dir = tempfile.mkdtemp()
+    git = ["git", "-C", repo_dir, "-c", "user.name=Poirot",
+           "-c", "user.email=poirot@example.com"]
+    execute_cmd(["git", "init", "-q", repo_dir])
+    for message, files in commits:
+        for path, content in files.items():
+            if content is None:
+                os.remove(os.path.join(repo_dir, path))
+            else:
+                with open(os.path.join(repo_dir, path), "w") as outfile:
+                    outfile.write(content)
+        execute_cmd(git + ["add", "-A"])
+        execute_cmd(git + ["commit", "-q", "-m", message])
+    return repo_dir
+
+
+local_commits = [
+    ("first password: x", {"f.txt": "a\npassword = hunter2\nAPIKEY=1\n"}),
+    ("second", {"f.txt": "a\npassword = hunter3\nAPIKEY=1\nfrabjous\n",
+                "g.txt": "x_KEY\n"}),
+    ("delete g", {"g.txt": None})
+]
+
+
 def setUp():
     execute_cmd(["mkdir", test_dir])
 
@@ -39,6 +96,11 @@ def test_execute_cmd():
     eq_(err, "")
 
 
+def test_execute_cmd_latin1():
+    eq_(execute_cmd(["printf", "caf\\351"]), (u"caf\xe9", ""))
+    eq_(execute_cmd(["printf", "caf\\351"], raw=True)[0], b"caf\xe9")
+
+
 def test_ask():
     response = ask(question="Answer y", options=["y", "n"], response="y")
     eq_(response, "y")
@@ -50,7 +112,7 @@ def test_merge_dicts():
 
 
 def test_info_parser():
-    eq_(len(info), 12)
+    eq_(len(info), 26)
     eq_(len(info["patterns"]), 18)
     eq_(info["revlist"], ["--all"])
     eq_(info["git_url"], "https://github.com/emanuelfeld/poirot-test-repo.git")
@@ -93,6 +155,681 @@ def test_parse_post_message():
     eq_(results[0][1]["message"].find("fake@fake.biz") == 0, True)
 
 
+def test_search_history():
+    repo_dir = make_repo(local_commits)
+    local_args = ["--dir={}".format(repo_dir), "--revlist=all", "--term=frabjous",
+                  "--patterns=poirot/patterns/default.txt"]
+    try:
+        per_pattern = Poirot(args=local_args, render_results=False)
+        for pattern in per_pattern.info["patterns"]:
+            per_pattern.add_committed_results(pattern)
+        single_pass = Poirot(args=local_args, render_results=False)
+        single_pass.search_history()
+        eq_(single_pass.results["frabjous"], per_pattern.results["frabjous"])
+        eq_(single_pass.results["_KEY"], per_pattern.results["_KEY"])
+        password = single_pass.results["pass(word?)[[:blank:]]*[=:][[:blank:]]*.+"]
+        eq_(len(password), 2)
+        eq_(sum("message" in metadata for metadata in password.values()), 1)
+    finally:
+        shutil.rmtree(repo_dir)
+
+
+def test_search_history_message_body():
+    repo_dir = make_repo([("subject\n\nbody with password: x", {"f.txt": "APIKEY=1\n"}),
+                          ("another\n\nbody", {"f.txt": "APIKEY=2\n"})])
+    try:
+        results = main(args=["--dir={}".format(repo_dir), "--revlist=all", "--term=APIKEY",
+                             "--patterns={}".format(os.devnull)], render_results=False)
+        eq_(len(results["APIKEY"]), 2)
+        ok_(isinstance(results, dict))
+        eq_(json.loads(json.dumps(results)), results)  # callers can serialize the results
+        results = main(args=["--dir={}".format(repo_dir), "--revlist=all", "--term=password"],
+                       render_results=False)
+        eq_(len(results["password"]), 1)
+    finally:
+        shutil.rmtree(repo_dir)
+
+
+def test_log_fields():
+    message = "COMMIT: x AUTHORDATE: y LOG: password: z"
+    repo_dir = make_repo([(message, {"a.txt": "password = 1\n"})])
+    with open(os.path.join(repo_dir, "b.txt"), "wb") as outfile:
+        outfile.write(b"caf\xe9 password = 2\n")
+    execute_cmd(["git", "-C", repo_dir, "add", "b.txt"])
+    execute_cmd(["git", "-C", repo_dir, "-c", "user.name=Poirot", "-c", "user.email=poirot@example.com",
+                 "commit", "-q", "-m", "latin-1"])
+    local_args = ["--dir={}".format(repo_dir), "--revlist=all", "--term=password"]
+    try:
+        single_pass = Poirot(args=local_args, render_results=False)
+        single_pass.search_history()
+        per_pattern = Poirot(args=local_args, render_results=False)
+        per_pattern.add_committed_results("password")
+        for results in (single_pass.results["password"], per_pattern.results["password"]):
+            eq_([metadata["message"] for metadata in results.values() if "message" in metadata],
+                [message])
+            for metadata in results.values():
+                eq_(metadata["author_name"], "Poirot")
+                eq_(metadata["author_email"], "poirot@example.com")
+            texts = [match["text"] for metadata in results.values()
+                     for file_diff in metadata["files"] for match in file_diff["matches"]]
+            eq_(sorted(texts), [u"caf\xe9 password = 2", "password = 1"])
+    finally:
+        shutil.rmtree(repo_dir)
+
+
+def test_lru_cache():
+    cache = LRUCache(max_bytes=10)
+    cache.put("a", 1, 4)
+    cache.put("b", 2, 4)
+    eq_(cache.get("a"), 1)
+    cache.put("c", 3, 4)  # evicts b, the least recently used
+    eq_(cache.get("b"), None)
+    eq_(cache.get("a"), 1)
+    cache.put("d", 4, 11)  # larger than the whole budget
+    ok_("d" not in cache)
+    eq_(cache.size, 8)
+
+
+def test_result_store():
+    store = ResultStore(["a", "b"])
+    author = {"author_name": "Poirot", "author_email": "poirot@example.com", "author_date": "today"}
+    files = [{"file": "f.txt", "matches": [{"line": 1, "text": "a b", "span": [0, 1]}]}]
+    store.add("b", "abc123", dict(author, files=files))
+    store.add("a", "abc123", dict(author, message="a b", message_span=[0, 1]))
+    store.add("a", "abc123", dict(author, files=files))
+    store.add("b", "def456", dict(author, files=[{"file": "f.txt", "matches": [{"line": 2, "text": "b"}]}]))
+    eq_(store.to_dict(), {
+        "a": {"abc123": dict(author, message="a b", message_span=[0, 1], files=files)},
+        "b": {"abc123": dict(author, files=files),
+              "def456": dict(author, files=[{"file": "f.txt", "matches": [{"line": 2, "text": "b"}]}])}
+    })
+    eq_(list(store.to_dict()["b"]), ["abc123", "def456"])
+    eq_(len(store.commits), 2)
+    ok_(store.commits["abc123"].author_name is store.commits["def456"].author_name)
+    ok_(store.commits["abc123"].hits["b"].files[0][0] is store.commits["def456"].hits["b"].files[0][0])
+
+    results = store.view()
+    eq_(results, store.to_dict())
+    eq_(list(results["b"]), ["abc123", "def456"])
+    ok_("def456" not in results["a"])
+    assert_raises(KeyError, lambda: results["c"])
+    out = io.StringIO()
+    write_json(results, out, {"extra": [1]})
+    eq_(out.getvalue(), json.dumps(dict(store.to_dict(), extra=[1]), ensure_ascii=False, indent=4,
+                                   separators=(",", ": ")))
+    empty = io.StringIO()
+    write_json(ResultStore([]).view(), empty)
+    eq_(empty.getvalue(), "{}")
+
+
+def test_commit_diff_cache():
+    repo_dir = make_repo(local_commits)
+    try:
+        P = Poirot(args=["--dir={}".format(repo_dir), "--term=frabjous"], render_results=False)
+        sha = execute_cmd(["git", "-C", repo_dir, "rev-parse", "--short", "HEAD~1"])[0].strip()
+        added_lines = list(P.iter_commit_diff(sha))
+        ok_(P.diff_cache.get(sha)[0] == added_lines)
+        eq_(added_lines[-1], ("g.txt", 1, "+x_KEY"))
+        for pattern in ["frabjous", "_KEY"]:
+            results = list(P.search_committed(target="diff", pattern=pattern, commit_range="--all"))
+            eq_(results[0][0], sha)
+        eq_(len(P.diff_cache), 2)  # _KEY's removal in HEAD is fetched too
+        P = Poirot(args=["--dir={}".format(repo_dir), "--term=frabjous", "--max-line-length=3"],
+                   render_results=False)
+        cut = list(P.iter_commit_diff(sha))
+        skipped = P.limits.drain()
+        eq_(skipped, {"truncated": 3})
+        eq_(list(P.iter_commit_diff(sha)), cut)
+        eq_(P.limits.drain(), skipped)  # counted again when the cached diff is used
+    finally:
+        shutil.rmtree(repo_dir)
+
+
+def test_search_all_staged():
+    repo_dir = make_repo(local_commits)
+    cwd = os.getcwd()
+    try:
+        with open(os.path.join(repo_dir, "h.txt"), "w") as outfile:
+            outfile.write("SESSIONTOKEN=abc\nfrabjous day\n")
+        execute_cmd(["git", "-C", repo_dir, "add", "h.txt"])
+        os.chdir(repo_dir)
+        P = Poirot(args=["--dir={}".format(repo_dir), "--staged",
+                         "--term=frabjous", "--patterns={}/poirot/patterns/default.txt".format(cwd)],
+                   render_results=False)
+        P.search_all()
+        eq_(P.results["frabjous"]["staged"]["files"][0]["matches"][0]["line"], 2)
+        eq_(P.results["SESSIONTOKEN"]["staged"]["files"][0]["file"], "h.txt")
+        eq_(P.results["_KEY"], {})
+        eq_(P.search_staged("SESSIONTOKEN"), P.results["SESSIONTOKEN"]["staged"]["files"])
+        eq_(P.diff_cache.get("staged")[0][0], ("h.txt", 1, "+SESSIONTOKEN=abc"))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(repo_dir)
+
+
+def test_iter_added_lines():
+    diff = ["diff --git a/a.txt b/a.txt\n",
+            "index 8c199b3..e2385f3 100644\n",
+            "--- a/a.txt\n",
+            "+++ b/a.txt\n",
+            "@@ -2 +2 @@ a\n",
+            "-old\n",
+            "+++new\n",
+            "@@ -3,0 +10,2 @@\n",
+            "+diff --git x\n",
+            "+last\n",
+            "diff --git a/b.txt b/b.txt\n",
+            "deleted file mode 100644\n",
+            "--- a/b.txt\n",
+            "+++ /dev/null\n",
+            "@@ -1 +0,0 @@\n",
+            "-gone\n"]
+    eq_(list(iter_added_lines(iter(diff))),
+        [("a.txt", 2, "+++new"), ("a.txt", 10, "+diff --git x"), ("a.txt", 11, "+last")])
+
+
+def test_limits():
+    diff = ["diff --git a/a.txt b/a.txt\n",
+            "@@ -0,0 +1,3 @@\n",
+            "+short\n",
+            "+" + "x" * 50 + "\n",
+            "+over limit\n",
+            "diff --git a/logo.png b/logo.png\n",
+            "index 8c199b3..e2385f3 100644\n",
+            "Binary files a/logo.png and b/logo.png differ\n",
+            "diff --git a/vendor/lib.js b/vendor/lib.js\n",
+            "@@ -0,0 +1 @@\n",
+            "+vendored\n"]
+    limits = Limits(max_diff_size=20, max_line_length=10, exclude=["vendor/*"])
+    eq_(list(iter_added_lines(iter(diff), limits)),
+        [("a.txt", 1, "+short"), ("a.txt", 2, "+" + "x" * 10)])
+    eq_(limits.summary(), "Skipped 1 binary file, 1 excluded file, 1 file cut short by "
+                          "--max-diff-size, 1 line cut short by --max-line-length")
+    eq_(limits.drain(), {"binary": 1, "excluded": 1, "oversized": 1, "truncated": 1})
+    eq_(limits.summary(), None)
+
+
+def test_required_literal():
+    eq_(required_literal("pass(word?)[[:blank:]]*[=:][[:blank:]]*.+"), "pass")
+    eq_(required_literal("BEGIN CERTIFICATE"), "begin certificate")
+    eq_(required_literal("jdbc:[[:alnum:]]+://[^\\s]+"), "jdbc:")
+    eq_(required_literal("x{0,2}yz"), "yz")
+    eq_(required_literal("a\\.b"), "a.b")
+    eq_(required_literal("foo|bar"), None)
+    eq_(required_literal("(?i)abc"), None)
+    eq_(required_literal("[0-9a-f]{1,4}"), None)
+
+
+def test_pattern_set():
+    patterns = PatternSet(["_KEY", "APIKEY", "[0-9]{3}[-.][0-9]{4}"])
+    eq_(patterns.unfiltered, ["[0-9]{3}[-.][0-9]{4}"])
+    eq_(patterns.candidates("nothing to see"), ["[0-9]{3}[-.][0-9]{4}"])
+    eq_(sorted(p for p, match in patterns.search("+API_KEY=APIKEY 555-1234")),
+        ["APIKEY", "[0-9]{3}[-.][0-9]{4}", "_KEY"])
+    eq_(patterns.search("+secret_key")[0][1].group(0), "_key")
+    (pattern, match), = patterns.search_message("one\napikey two")
+    eq_((pattern, match.span()), ("APIKEY", (4, 10)))
+
+
+def test_regex_timeout():
+    pattern_set = PatternSet(["(.+)=(.+)=(.+)=(.+)!", "a="], timeout=0.05)
+    hits = pattern_set.search("a=" * 1000)
+    eq_([pattern for pattern, match in hits], ["a="])
+    eq_(pattern_set.timeouts, {"(.+)=(.+)=(.+)=(.+)!": 1})
+
+
+def test_parse_patterns_profiling():
+    handle, path = tempfile.mkstemp(suffix=".txt")
+    with os.fdopen(handle, "w") as outfile:
+        outfile.write("# Slow\n(.+)=(.+)=(.+)=(.+)!\n\n# Broken\n(unclosed\n\n# Fine\nAPIKEY\n")
+    try:
+        eq_(parse_patterns(path, timeout=0.05), {"APIKEY": "Fine"})
+        eq_(len(parse_patterns(path, timeout=0)), 3)
+        for term in ["(unclosed", "(.+)=(.+)=(.+)=(.+)!"]:  # --term is checked like the patterns in files
+            patterns = parse_arguments(["--term=" + term, "--patterns=" + path, "--regex-timeout=0.05"])["patterns"]
+            eq_(patterns, {"APIKEY": "Fine"})
+    finally:
+        os.remove(path)
+
+
+def test_pattern_file_cache():
+    serve_dir, cache_dir = tempfile.mkdtemp(), tempfile.mkdtemp()
+    with open(os.path.join(serve_dir, "patterns.txt"), "w") as outfile:
+        outfile.write("# Keys\nAPIKEY\n")
+    statuses = []
+
+    class Handler(SimpleHTTPRequestHandler):
+        def translate_path(self, path):
+            return os.path.join(serve_dir, path.lstrip("/"))
+
+        def send_response(self, code, *args):
+            statuses.append(code)
+            SimpleHTTPRequestHandler.send_response(self, code, *args)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    url = "http://127.0.0.1:{}/patterns.txt".format(server.server_port)
+    missing = "http://127.0.0.1:{}/missing.txt".format(server.server_port)
+    try:
+        fetched = PatternFileCache(cache_dir, ttl=0).fetch_all([url, missing])
+        eq_(fetched, {url: "# Keys\nAPIKEY\n", missing: None})
+        eq_(sorted(statuses), [200, 404])
+        eq_(PatternFileCache(cache_dir, ttl=0).fetch(url), "# Keys\nAPIKEY\n")  # revalidated
+        eq_(statuses[-1], 304)
+        eq_(PatternFileCache(cache_dir).fetch(url), "# Keys\nAPIKEY\n")  # still fresh
+        eq_(len(statuses), 3)
+        eq_(parse_patterns(url, fetched=fetched), {"APIKEY": "Keys"})
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+    try:
+        eq_(PatternFileCache(cache_dir, ttl=0).fetch(url), "# Keys\nAPIKEY\n")  # server gone
+        eq_(PatternFileCache(cache_dir, ttl=0, offline=True).fetch(url), "# Keys\nAPIKEY\n")
+        eq_(PatternFileCache(cache_dir, offline=True).fetch(missing), None)
+    finally:
+        shutil.rmtree(serve_dir)
+        shutil.rmtree(cache_dir)
+
+
+def test_git_backend():
+    repo_dir = make_repo(local_commits)
+    git = GitBackend(os.path.join(repo_dir, ".git"))
+    try:
+        head = git.run(["rev-parse", "HEAD~1"])[0].strip()
+        first = git.diff(head)
+        next(first)
+        first.close()  # the rest of the diff is skipped over
+        eq_(list(iter_added_lines(git.diff(head)))[-1], ("g.txt", 1, "+x_KEY"))
+        object_type, contents = git.read_object(head)
+        eq_(object_type, "commit")
+        ok_(contents.startswith(b"tree "))
+        eq_(git.read_object("0" * 40), None)
+        eq_(git.read_object(head + ":f.txt")[1].decode("utf-8").splitlines()[-1], "frabjous")
+        object_sha, object_type, reader = git.open_object(head + ":f.txt")
+        eq_(reader.peek(3), b"a\np")
+        eq_(reader.readline(), b"a\n")
+        eq_(reader.readline(4), b"pass")
+        reader.close()  # the rest of the blob is skipped over
+        eq_(git.read_object(head)[0], "commit")
+        queries = [["rev-parse", "HEAD~{}".format(n)] for n in range(3)]
+        outputs, threads = {}, set()
+
+        def on_output(index, out):
+            outputs[index] = out
+            threads.add(threading.current_thread().name)
+
+        git.run_all(queries, on_output)
+        eq_(outputs, {n: git.run(args, raw=True)[0] for n, args in enumerate(queries)})
+        eq_(len(threads), 1)  # one at a time, on a single thread
+        serial = {}
+        git.run_all(queries, lambda index, out: serial.setdefault(index, out), limit=1)
+        eq_(serial, outputs)
+    finally:
+        git.close()
+        shutil.rmtree(repo_dir)
+
+
+def test_blob_deduplication():
+    repo_dir = make_repo(local_commits[:1])
+    git = ["git", "-C", repo_dir, "-c", "user.name=Poirot", "-c", "user.email=poirot@example.com"]
+    try:
+        # the same change to f.txt, committed on two branches
+        base = execute_cmd(git + ["rev-parse", "HEAD"])[0].strip()
+        for branch in ["one", "two"]:
+            execute_cmd(git + ["checkout", "-q", "-b", branch, base])
+            with open(os.path.join(repo_dir, "f.txt"), "a") as outfile:
+                outfile.write("frabjous\n")
+            execute_cmd(git + ["commit", "-q", "-a", "-m", "backport " + branch])
+        P = Poirot(args=["--dir={}".format(repo_dir), "--revlist=all", "--term=frabjous"],
+                   render_results=False)
+        searched = []
+        search = P.pattern_set.search
+        P.pattern_set.search = lambda line: searched.append(line) or search(line)
+        P.search_history()
+        frabjous = P.results["frabjous"]
+        eq_(len(frabjous), 2)
+        for metadata in frabjous.values():
+            eq_(metadata["files"], [{"file": "f.txt",
+                                     "matches": [{"line": 4, "text": "frabjous", "span": [0, 8]}]}])
+        eq_(searched.count("+frabjous"), 1)
+    finally:
+        shutil.rmtree(repo_dir)
+
+
+def test_search_history_parallel():
+    repo_dir = make_repo(local_commits)
+    local_args = ["--dir={}".format(repo_dir), "--revlist=all", "--term=frabjous",
+                  "--patterns=poirot/patterns/default.txt"]
+    try:
+        serial = Poirot(args=local_args, render_results=False)
+        serial.search_history()
+        parallel = Poirot(args=local_args + ["--jobs=2"], render_results=False)
+        parallel.search_history()
+        eq_(parallel.results, serial.results)
+        eq_([list(commits) for commits in parallel.results.values()],
+            [list(commits) for commits in serial.results.values()])
+    finally:
+        shutil.rmtree(repo_dir)
+
+
+def test_search_tree():
+    repo_dir = make_repo(local_commits)
+    local_args = ["--dir={}".format(repo_dir), "--term=frabjous",
+                  "--patterns=poirot/patterns/default.txt"]
+    try:
+        with open(os.path.join(repo_dir, "f.txt"), "a") as outfile:
+            outfile.write("frabjous again\n")
+        with open(os.path.join(repo_dir, "h.bin"), "wb") as outfile:
+            outfile.write(b"frabjous\x00")
+        committed = Poirot(args=local_args + ["--tree=HEAD~1"], render_results=False)
+        committed.search_all()
+        eq_(committed.results["frabjous"]["tree"]["files"][0]["matches"][0]["line"], 4)
+        eq_(committed.results["_KEY"]["tree"]["files"][0]["file"], "g.txt")
+        on_disk = Poirot(args=local_args + ["--tree"], render_results=False)
+        on_disk.search_all()
+        eq_(on_disk.results["frabjous"]["tree"]["files"],
+            [{"file": "f.txt", "matches": [{"line": 4, "text": "frabjous", "span": [0, 8]},
+                                           {"line": 5, "text": "frabjous again", "span": [0, 8]}]}])
+        eq_(on_disk.results["_KEY"], {})
+        parallel = Poirot(args=local_args + ["--tree", "--jobs=2"], render_results=False)
+        parallel.search_all()
+        eq_(parallel.results, on_disk.results)
+    finally:
+        shutil.rmtree(repo_dir)
+
+
+def test_tree_limits():
+    repo_dir = make_repo([("minified", {"a.min.js": "frabjous " + "x" * 100000 + "\nfrabjous\n",
+                                        "b.txt": "pad\n" * 1000 + "frabjous\n",
+                                        "c.txt": "frabjous\n"})])
+    local_args = ["--dir={}".format(repo_dir), "--term=frabjous", "--max-line-length=20",
+                  "--max-diff-size=100"]
+    try:
+        for tree in ["--tree=HEAD", "--tree"]:
+            P = Poirot(args=local_args + [tree], render_results=False)
+            P.search_all()
+            eq_(P.results["frabjous"]["tree"]["files"],
+                [{"file": "a.min.js", "matches": [{"line": 1, "text": "frabjous " + "x" * 11, "span": [0, 8]},
+                                                  {"line": 2, "text": "frabjous", "span": [0, 8]}]},
+                 {"file": "c.txt", "matches": [{"line": 1, "text": "frabjous", "span": [0, 8]}]}])
+            eq_(P.limits.drain(), {"oversized": 1, "truncated": 1})
+            P.git.close()
+        lines = iter_lines(io.BytesIO(u"\u00e9\u00e9\u00e9\u00e9\n".encode("utf-8") * 2).readline, 2)
+        eq_(list(lines), [(1, u"\u00e9\u00e9\u00e9\u00e9"), (2, u"\u00e9\u00e9\u00e9\u00e9")])
+        lines = iter_lines(io.BytesIO(u"\u00e9".encode("utf-8") * 100).readline, 2)
+        eq_(list(lines), [(1, u"\u00e9" * 8)])  # not cut in the middle of a character
+    finally:
+        shutil.rmtree(repo_dir)
+
+
+def test_trigram_index():
+    repo_dir = make_repo(local_commits)
+    index_path = os.path.join(repo_dir, ".git", "poirot_index.sqlite")
+    local_args = ["--dir={}".format(repo_dir), "--revlist=all"]
+    try:
+        for term in ("frabjous", "hunter[0-9]", "pass(word)?"):
+            unindexed = Poirot(args=local_args + ["--term=" + term], render_results=False)
+            unindexed.search_history()
+            indexed = Poirot(args=local_args + ["--term=" + term, "--index"], render_results=False)
+            indexed.search_history()
+            eq_(indexed.results, unindexed.results)
+
+        index = TrigramIndex(index_path)
+        shas = execute_cmd(["git", "-C", repo_dir, "rev-list", "--all"])[0].split()
+        eq_(index.missing(shas), [])
+        eq_(index.candidates(shas, PatternSet(["frabjous"])), shas[1:2])
+        eq_(index.candidates(shas, PatternSet(["HUNTER[23]"])), shas[1:])
+        eq_(index.candidates(shas, PatternSet(["[0-9]+"])), shas)
+        index.close()
+    finally:
+        shutil.rmtree(repo_dir)
+
+
+def test_ndjson_output():
+    repo_dir = make_repo(local_commits)
+    output = os.path.join(repo_dir, "results.ndjson")
+    try:
+        results = main(args=["--dir={}".format(repo_dir), "--revlist=all", "--term=x_KEY", "--output={}".format(output),
+                             "--output-format=ndjson"], render_results=False)
+        eq_(results, {"x_KEY": {}})  # written out rather than kept
+        with open(output) as infile:
+            records = [json.loads(line) for line in infile]
+        eq_(len(records), 1)
+        eq_(records[0]["pattern"], "x_KEY")
+        eq_(records[0]["file"], "g.txt")
+        eq_(records[0]["line"], 1)
+        eq_(records[0]["text"], "x_KEY")
+        eq_(records[0]["author_email"], "poirot@example.com")
+        (out, err) = execute_cmd([sys.executable, "-c", "import sys; from poirot.poirot import main; main(sys.argv[1:])",
+                                  "--dir={}".format(repo_dir), "--revlist=all", "--output-format=ndjson"])
+        ok_("No patterns given!" in err)
+        records = [json.loads(line) for line in out.splitlines()]  # nothing but records on standard output
+        ok_(records)
+        try:  # the stats record doesn't count as a match
+            main(args=["--dir={}".format(repo_dir), "--revlist=all", "--term=nowhere", "--stats",
+                       "--output={}".format(output), "--output-format=ndjson"])
+        except SystemExit as exit:
+            eq_(exit.code, 0)
+    finally:
+        shutil.rmtree(repo_dir)
+
+
+def test_stats():
+    repo_dir = make_repo(local_commits)
+    output = os.path.join(repo_dir, "results.json")
+    try:
+        for jobs in ["1", "2"]:
+            results = main(args=["--dir={}".format(repo_dir), "--revlist=all", "--term=x_KEY", "--stats",
+                                 "--output={}".format(output), "--jobs={}".format(jobs)], render_results=False)
+            ok_("_poirot_stats" not in results)
+            with open(output) as infile:
+                report = json.load(infile)["_poirot_stats"]
+            ok_(report["subprocesses"] > 0)
+            ok_(report["bytes_read"] > 0)
+            ok_(report["lines_scanned"] > 0)
+            eq_(report["messages_scanned"], 3)
+            eq_(report["patterns"]["x_KEY"]["matches"], 1)
+            for step in ("read_git", "parse_log", "parse_diff"):
+                ok_(report["steps"][step]["calls"] > 0)
+            if jobs == "1":  # steps are timed apart from those within them, so they add up to the wall time at most
+                timed = sum(step["seconds"] for step in report["steps"].values()) + \
+                    sum(cost["seconds"] for cost in report["patterns"].values())
+                ok_(timed <= report["wall_seconds"])
+        for tree in ["--tree", "--tree=HEAD"]:
+            main(args=["--dir={}".format(repo_dir), "--term=x_KEY", "--stats", tree, "--jobs=2",
+                       "--output={}".format(output)], render_results=False)
+            with open(output) as infile:
+                report = json.load(infile)["_poirot_stats"]
+            ok_(report["steps"]["read_git" if tree == "--tree=HEAD" else "read_file"]["calls"] > 0)
+    finally:
+        shutil.rmtree(repo_dir)
+
+
+def test_batch_arguments():
+    batch_args, search_args = batch.parse_batch_arguments(["repo", "-rl=all", "-rt=2", "--results=out"])
+    eq_(batch_args.repos, ["repo"])
+    eq_(batch_args.results, "out")
+    eq_(search_args, ["-rl=all", "-rt=2"])  # poirot's own options, passed through
+    eq_(parse_arguments(search_args)["revlist"], ["--all"])
+
+
+def test_batch():
+    repo_dirs = [make_repo(local_commits), make_repo(local_commits[:1])]
+    work_dir = tempfile.mkdtemp()
+    results_dir = os.path.join(work_dir, "results")
+    repos = ["file://" + repo_dirs[0], repo_dirs[1], os.path.join(work_dir, "missing")]
+    args = repos + ["--clone-dir={}".format(os.path.join(work_dir, "repos")), "--results={}".format(results_dir),
+                    "--jobs=2", "--revlist=all", "--term=x_KEY"]
+    try:
+        for run in range(2):  # clones the first repository, then pulls it
+            summary = batch.main(args=args, render_results=False)
+            eq_(summary["totals"], {"repos": 3, "scanned": 2, "failed": 1, "matched": 1})
+            eq_([record["status"] for record in summary["repos"]], ["ok", "ok", "failed"])
+            eq_(summary["repos"][0]["matches"], {"x_KEY": 1})
+            with open(summary["repos"][0]["results"]) as infile:
+                eq_(len(json.load(infile)["x_KEY"]), 1)
+        ok_(os.path.exists(os.path.join(results_dir, "summary.json")))
+    finally:
+        for directory in repo_dirs + [work_dir]:
+            shutil.rmtree(directory)
+
+
+def test_daemon():
+    repo_dir = make_repo(local_commits)
+    socket_path = os.path.join(tempfile.mkdtemp(), "poirot.sock")
+    server = daemon.Daemon(socket_path)
+    thread = threading.Thread(target=server.serve)
+    thread.start()
+    try:
+        for _ in range(100):  # wait for the daemon to listen
+            if daemon.request({"command": "ping"}, socket_path):
+                break
+            time.sleep(0.05)
+        with open(os.path.join(repo_dir, "h.txt"), "w") as outfile:
+            outfile.write("APIKEY=2\n")
+        execute_cmd(["git", "-C", repo_dir, "add", "h.txt"])
+
+        args = ["--staged", "--term=APIKEY", "--dir={}".format(repo_dir)]
+        for _ in range(2):  # compiles the patterns once, then reuses them
+            response = daemon.request({"args": args, "cwd": repo_dir}, socket_path)
+            eq_(response["status"], 1)
+            ok_("APIKEY" in response["output"])
+        eq_(len(server.pattern_sets), 1)
+        response = daemon.request({"args": ["--term=APIKEY"], "cwd": repo_dir}, socket_path)
+        ok_("error" in response)
+        getuid = os.getuid
+        os.getuid = lambda: getuid() + 1  # as though another user owned the socket
+        try:
+            eq_(daemon.request({"command": "ping"}, socket_path), None)
+        finally:
+            os.getuid = getuid
+    finally:
+        daemon.request({"command": "stop"}, socket_path)
+        thread.join()
+        shutil.rmtree(repo_dir)
+        shutil.rmtree(os.path.dirname(socket_path))
+    eq_(daemon.request({"command": "ping"}, socket_path), None)
+
+
+def test_daemon_socket_path():
+    environ = dict(os.environ)
+    temp_dir = tempfile.mkdtemp()
+    try:
+        os.environ.pop("POIROT_SOCKET", None)
+        os.environ["XDG_RUNTIME_DIR"] = temp_dir
+        eq_(daemon.get_socket_path(), os.path.join(temp_dir, "poirot.sock"))
+        del os.environ["XDG_RUNTIME_DIR"]
+        ok_(daemon.get_socket_dir().endswith("poirot-{}".format(os.getuid())))
+
+        private_dir = os.path.join(temp_dir, "private")
+        daemon.make_private_dir(private_dir)
+        daemon.make_private_dir(private_dir)  # already there
+        eq_(os.stat(private_dir).st_mode & 0o777, 0o700)
+        os.chmod(private_dir, 0o777)  # e.g. made by another user to pose as the daemon
+        assert_raises(IOError, daemon.make_private_dir, private_dir)
+        ok_(not daemon.is_own_socket(private_dir))
+    finally:
+        os.environ.clear()
+        os.environ.update(environ)
+        shutil.rmtree(temp_dir)
+
+
+def test_incremental_state():
+    repo_dir = make_repo(local_commits)
+    state_args = ["--dir={}".format(repo_dir), "--revlist=all", "--term=frabjous", "--state"]
+    try:
+        first = Poirot(args=state_args, render_results=False)
+        first.search_history()
+        (sha, metadata), = first.results["frabjous"].items()
+        eq_(os.path.exists(os.path.join(repo_dir, ".git", "poirot_state.json")), True)
+
+        # mark the stored result to tell whether it is reused or rescanned
+        first.state.scans["--all"]["results"]["frabjous"][sha]["author_name"] = "Stored"
+        first.state.save()
+        with open(os.path.join(repo_dir, "k.txt"), "w") as outfile:
+            outfile.write("frabjous again\n")
+        execute_cmd(["git", "-C", repo_dir, "add", "k.txt"])
+        execute_cmd(["git", "-C", repo_dir, "-c", "user.name=Poirot",
+                     "-c", "user.email=poirot@example.com", "commit", "-q", "-m", "new"])
+
+        second = Poirot(args=state_args, render_results=False)
+        second.search_history()
+        frabjous = second.results["frabjous"]
+        eq_(len(frabjous), 2)
+        eq_(frabjous[sha]["author_name"], "Stored")
+        eq_(second.state.get("--all")["tips"], second.get_tips("--all"))
+    finally:
+        shutil.rmtree(repo_dir)
+
+
+def test_match_spans():
+    added_lines = [("a.txt", 1, "+   token = MY_API_KEY  "), ("a.txt", 2, "+apikey")]
+    matches = list(iter_matches(added_lines, PatternSet(["_KEY", "^\\+api"])))
+    eq_(matches[0], ("_KEY", "a.txt", {"line": 1, "text": "token = MY_API_KEY", "span": [14, 18]}))
+    eq_(matches[1][2]["span"], [0, 3])  # the match's leading + is not part of the text
+    eq_(highlight("token = MY_API_KEY", "_KEY", [14, 18]),
+        "token = MY_API" + style("_KEY", "red"))
+    eq_(highlight("a_key and _KEY", "_KEY"), "a" + style("_key", "red") + " and _KEY")
+
+
+def test_entropy():
+    added_lines = [("a.txt", 1, "+secret = 'x8Jq2LmZ9vR4tK7wNpB3cY6hF1dG5sA0'"),
+                   ("a.txt", 2, "+def get_application_configuration_value():"),
+                   ("b.txt", 1, "+sha = 'e3b0c44298fc1c149afbf4c8996fb92427ae41e4'")]
+    pattern_set = PatternSet(["secret"], detector=EntropyDetector(batch_size=2))
+    matches = list(iter_matches(added_lines, pattern_set))
+    eq_([(pattern, filename) for pattern, filename, match in matches],
+        [("secret", "a.txt"), (ENTROPY_PATTERN, "a.txt"), (ENTROPY_PATTERN, "b.txt")])
+    eq_(matches[1][2]["span"], [10, 42])
+    eq_(score_tokens(["aaaa", "abcd"]), [0.0, 2.0])
+    eq_(score_tokens_python(["aaaa", "abcd"]), [0.0, 2.0])
+
+
+def test_entropy_numpy():
+    if entropy.numpy is None:
+        raise SkipTest("NumPy is not installed")
+    tokens = ["aaaa", "abcd", "x8Jq2LmZ9vR4tK7wNpB3cY6hF1dG5sA0", "e3b0c44298fc1c149afbf4c8996fb92427ae41e4"]
+    for expected, score in zip(score_tokens_python(tokens), score_tokens_numpy(tokens)):
+        ok_(abs(expected - score) < 1e-9)
+
+
+def test_import_budget():
+    """
+    Imports Poirot and searches staged changes in a fresh interpreter,
+    checking that it stays within IMPORT_BUDGET and that none of the
+    heavy dependencies only some searches need have been loaded.
+    """
+
+    repo_dir = make_repo(local_commits)
+    with open(os.path.join(repo_dir, "h.txt"), "w") as outfile:
+        outfile.write("APIKEY=2\n")
+    execute_cmd(["git", "-C", repo_dir, "add", "h.txt"])
+    script = """if True:
+        import os, sys, json, time
+        start = time.time()
+        from poirot.poirot import main
+        elapsed = time.time() - start
+        os.chdir(sys.argv[1])
+        main(["--staged", "--term=APIKEY", "--dir=" + sys.argv[1], "--output=" + os.devnull],
+             render_results=False)
+        print(json.dumps([elapsed, sorted(sys.modules)]))
+        """
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+    try:
+        out = subprocess.check_output([sys.executable, "-c", script, repo_dir], env=env)
+        elapsed, modules = json.loads(out.decode("utf-8").splitlines()[-1])
+        ok_(elapsed < IMPORT_BUDGET, "importing Poirot took {:.3f}s".format(elapsed))
+        for heavy in ["jinja2", "tqdm", "requests", "multiprocessing", "poirot.clients"]:
+            ok_(heavy not in modules, "{} was imported".format(heavy))
+    finally:
+        shutil.rmtree(repo_dir)
+
+
 def test_chunk_text():
     output = wrap(text="a b c d e f g", line_length=3, padding=0).split("\n")
     eq_(output[0], "a b")